@@ -10,6 +10,10 @@ from services import get_collection_stats, clear_database, get_docstore, ParentC
 
 router = APIRouter()
 
+PDF_MAGIC = b"%PDF-"
+# Upload copy buffer: a manual is tens of MB, so copy in 1 MiB steps rather than 64 KiB
+UPLOAD_COPY_CHUNK = 1 << 20
+
 def get_rag_system(request: Request):
     if not hasattr(request.app.state, "rag_system"): return None
     return request.app.state.rag_system
@@ -37,20 +41,30 @@ def read_root(request: Request):
 
 
 @router.post("/ingest", response_model=IngestResponse)
-async def upload_manual(request: Request, file: UploadFile = File(...), force_reingest: bool = False):
+def upload_manual(request: Request, file: UploadFile = File(...), force_reingest: bool = False):
     pipe = get_ingestion_pipeline(request)
     if not pipe: raise HTTPException(503, "Ingestion unavailable")
     
     if not file.filename.endswith('.pdf'): raise HTTPException(400, "PDF only")
+    # Sniff the header before writing anything: a renamed non-PDF fails here, not deep in PyMuPDF
+    # (readers accept the header anywhere in the first 1 KiB, so the check does too)
+    if PDF_MAGIC not in file.file.read(1024): raise HTTPException(400, "PDF only")
+    file.file.seek(0)
     
+    # Handlers are plain def (threadpool), so this copy doesn't block the event loop
     path = os.path.join(DATA_FOLDER, file.filename)
-    with open(path, "wb") as f: shutil.copyfileobj(file.file, f)
+    with open(path, "wb") as f: shutil.copyfileobj(file.file, f, UPLOAD_COPY_CHUNK)
     
     print(f"[API] Saved: {path}")
     res = pipe.ingest_pdf(path, force=force_reingest)
     
     if res.get("status") == "success":
-        request.app.state.rag_system = ParentChildRAG(persist_dir=CHROMA_PERSIST_DIR)
+        rag = get_rag_system(request)
+        if rag is None:
+            request.app.state.rag_system = ParentChildRAG(persist_dir=CHROMA_PERSIST_DIR)
+        else:
+            # Same stores, new content: only what was cached before this ingest is stale
+            rag.reset_caches()
     
     return IngestResponse(
         message="Ingestion complete" if res["status"]=="success" else "Skipped",
@@ -61,7 +75,7 @@ async def upload_manual(request: Request, file: UploadFile = File(...), force_re
     )
 
 @router.post("/chat", response_model=ChatResponse)
-async def chat_endpoint(request: Request, chat_req: ChatRequest):
+def chat_endpoint(request: Request, chat_req: ChatRequest):
     """Chat endpoint."""
     rag = get_rag_system(request)
     if not rag: raise HTTPException(503, "System not ready")
@@ -80,8 +94,10 @@ async def chat_endpoint(request: Request, chat_req: ChatRequest):
 
 
 @router.post("/chat/stream")
-async def chat_stream(request: Request, chat_req: ChatRequest):
+def chat_stream(request: Request, chat_req: ChatRequest):
     """Streaming chat endpoint with agentic routing."""
+    # Plain def handlers and generators: routing, retrieval, reranking and Ollama streaming
+    # all block, so FastAPI and sse-starlette run them in the threadpool, off the event loop
     from sse_starlette.sse import EventSourceResponse
     from services import get_conversation_store, stream_chat_answer
     from services.llm.router import (
@@ -107,15 +123,15 @@ async def chat_stream(request: Request, chat_req: ChatRequest):
     routing = route_query(chat_req.query, history)
     decision = routing["decision"]
     
-    # Force RAG for visual queries (images, diagrams, etc.)
-    visual_keywords = ["show", "diagram", "picture", "image", "photo", "location", "look like", "see", "where is"]
-    is_visual = any(k in chat_req.query.lower() for k in visual_keywords)
+    # Force RAG for visual queries (images, diagrams, etc.); checked on the original query,
+    # before reformulation can strip the keywords
+    is_visual = rag._is_visual_query(chat_req.query)
     if is_visual and decision == QueryRoute.DIRECT_ANSWER:
         print(f"[ROUTER] Visual query detected, overriding to RAG_NEEDED")
         decision = QueryRoute.RAG_NEEDED
 
     if decision == QueryRoute.DIRECT_ANSWER:
-        async def direct_response():
+        def direct_response():
             yield {"event": "metadata", "data": json.dumps({
                 "conversation_id": conv_id, "num_sources": 0, "route": "direct"
             })}
@@ -126,7 +142,7 @@ async def chat_stream(request: Request, chat_req: ChatRequest):
         return EventSourceResponse(direct_response())
     
     if decision == QueryRoute.CLARIFICATION_NEEDED:
-        async def clarification_response():
+        def clarification_response():
             yield {"event": "metadata", "data": json.dumps({
                 "conversation_id": conv_id, "num_sources": 0, "route": "clarification"
             })}
@@ -137,7 +153,7 @@ async def chat_stream(request: Request, chat_req: ChatRequest):
         return EventSourceResponse(clarification_response())
     
     if decision == QueryRoute.OUT_OF_SCOPE:
-        async def out_of_scope_response():
+        def out_of_scope_response():
             yield {"event": "metadata", "data": json.dumps({
                 "conversation_id": conv_id, "num_sources": 0, "route": "out_of_scope"
             })}
@@ -154,8 +170,6 @@ async def chat_stream(request: Request, chat_req: ChatRequest):
         from services.retrieval.hybrid_search import hybrid_search
         from services.retrieval.reranker import rerank_results
         
-        # Check visual intent on ORIGINAL query (before reformulation strips keywords)
-        is_visual = rag._is_visual_query(chat_req.query)
         print(f"[API] is_visual={is_visual} for query: {chat_req.query[:50]}...")
         
         # Stage 1: Hybrid Search (Vector + BM25)
@@ -166,7 +180,7 @@ async def chat_stream(request: Request, chat_req: ChatRequest):
         print(f"[API] After hybrid: {len(child_docs)} docs ({img_count_hybrid} images)")
         
         if not child_docs:
-            async def no_results():
+            def no_results():
                 yield {"event": "metadata", "data": json.dumps({"conversation_id": conv_id, "num_sources": 0, "route": "rag"})}
                 yield {"event": "token", "data": "No relevant information found in the manual."}
                 yield {"event": "done", "data": ""}
@@ -223,7 +237,7 @@ async def chat_stream(request: Request, chat_req: ChatRequest):
         traceback.print_exc()
         raise HTTPException(500, str(e))
     
-    async def event_generator():
+    def event_generator():
         yield {
             "event": "metadata", 
             "data": json.dumps({
@@ -255,13 +269,16 @@ def get_stats(request: Request):
     
     s = pipe.get_stats()
     ds = get_docstore().get_stats()
+    rag_stats = rag.get_stats() if rag else {}
     return StatsResponse(
         children_count=s['children_count'],
         parents_count=s['parents_count'],
         docstore_parents=ds['total_parents'],
         persist_dir=s['persist_dir'],
         system_ready=rag is not None,
-        avg_parent_chars=ds['avg_chars']
+        avg_parent_chars=ds['avg_chars'],
+        query_cache=rag_stats.get("query_cache"),
+        answer_cache=rag_stats.get("answer_cache")
     )
 
 @router.delete("/reset")
@@ -271,6 +288,8 @@ def reset_database(request: Request, confirm: bool = False):
     
     clear_database()
     get_docstore().clear()
+    pipe = get_ingestion_pipeline(request)
+    if pipe: pipe.reset_indexed_hashes()
     request.app.state.rag_system = None
     print("[WARN] Database reset")
     return {"message": "Database cleared"}
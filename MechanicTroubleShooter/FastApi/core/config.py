@@ -7,7 +7,36 @@ CHROMA_DB_DIR = "./chroma_db"
 OLLAMA_URL = "http://localhost:11434/api/generate"
 TEXT_MODEL = "llama3.1"
 VISION_MODEL = "llava-phi3"
+# Requests Ollama serves at once per model (mirror the server's own OLLAMA_NUM_PARALLEL)
+OLLAMA_NUM_PARALLEL = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))
+
+# Documents per Chroma insert, and texts per embedding-model forward pass
+VECTOR_ADD_BATCH_SIZE = int(os.getenv("VECTOR_ADD_BATCH_SIZE", "256"))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "128"))
+
+# Semantic answer cache: entries, lifetime, and cosine similarity needed for a hit
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "256"))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "3600"))
+QUERY_CACHE_THRESHOLD = float(os.getenv("QUERY_CACHE_THRESHOLD", "0.95"))
+
+# Answers persisted across restarts, keyed by exact question and corpus version; "0" turns it off
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1") == "1"
+
+# INT8 cross-encoder for CPU: a local ONNX export (model.onnx + tokenizer files) if present,
+# otherwise this quantized file from the model's Hugging Face repo
+RERANKER_ONNX_DIR = os.getenv("RERANKER_ONNX_DIR", "./models/reranker-onnx")
+RERANKER_ONNX_FILE = os.getenv("RERANKER_ONNX_FILE", "onnx/model_qint8_avx512_vnni.onnx")
+
+# Cross-encoder checkpoint; point at a distilled domain model to swap it in
+RERANKER_MODEL = os.getenv("RERANKER_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+# (query, passage, score) log used as distillation data for that model; opt-in, since it
+# records every user query and passage text
+RERANK_LOG_ENABLED = os.getenv("RERANK_LOG_ENABLED", "0") == "1"
+RERANK_LOG_PATH = os.path.join(DATA_FOLDER, "rerank_log.jsonl")
+RERANK_LOG_MAX_BYTES = int(os.getenv("RERANK_LOG_MAX_BYTES", str(20 * 1024 * 1024)))
+
+# Level for modules that log through `logging` (retrieval); DEBUG shows per-query stages
+LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING").upper()
 
 os.makedirs(DATA_FOLDER, exist_ok=True)
 os.makedirs(CHROMA_DB_DIR, exist_ok=True)
-
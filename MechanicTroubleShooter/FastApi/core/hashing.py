@@ -0,0 +1,16 @@
+import os
+import mmap
+import hashlib
+
+
+def sha256_file(file_path: str) -> str:
+    with open(file_path, "rb") as f:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        
+        # mmap lets the hash stream over the whole file in C; empty files can't be mapped
+        sha = hashlib.sha256()
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                sha.update(mm)
+        return sha.hexdigest()
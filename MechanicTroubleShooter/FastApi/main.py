@@ -1,12 +1,15 @@
 import os
+import logging
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from core.config import DATA_FOLDER, CHROMA_PERSIST_DIR
+from core.config import DATA_FOLDER, CHROMA_PERSIST_DIR, LOG_LEVEL
 from services import MultimodalIngestionPipeline, ParentChildRAG
 from api.routes import router as api_router
 
+logging.basicConfig(level=LOG_LEVEL, format="%(message)s")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print("\n[INFO] Starting Server...")
@@ -29,3 +29,5 @@ class StatsResponse(BaseModel):
     persist_dir: str
     system_ready: bool
     avg_parent_chars: int
+    query_cache: Optional[Dict[str, Any]] = None
+    answer_cache: Optional[Dict[str, Any]] = None
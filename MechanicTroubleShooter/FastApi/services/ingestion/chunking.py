@@ -1,6 +1,7 @@
 
 import re
-from typing import List, Dict, Any, Tuple
+from bisect import bisect_right
+from typing import List, Dict, Any, Callable, Iterator, Optional, Tuple
 from langchain_core.documents import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from .pdf_processor import detect_vehicle_model
@@ -9,13 +10,50 @@ from .pdf_processor import detect_vehicle_model
 CHILD_CHUNK_SIZE = 2400  
 CHILD_CHUNK_OVERLAP = 400  
 
+# A whole line (ignoring surrounding whitespace) like "12. Engine Cooling" or "Brakes"
+_HEADER_RE = re.compile(
+    r'^[^\S\n]*(\d{1,2}\.?[^\S\n]*)?([A-Z](?:[a-zA-Z\-\&]|[^\S\n]){2,}[a-zA-Z\-\&])[^\S\n]*$',
+    re.MULTILINE
+)
+
+# Body lines worth keeping: not blank and not a bare page number
+_BODY_LINE_RE = re.compile(r'^(?![^\S\n]*\d*[^\S\n]*$)[^\n]*$', re.MULTILINE)
+
+# Chunk config is fixed, so one splitter is shared by every ingest
+_CHILD_SPLITTER = RecursiveCharacterTextSplitter(
+    chunk_size=CHILD_CHUNK_SIZE,  
+    chunk_overlap=CHILD_CHUNK_OVERLAP,  
+    separators=[
+        "\n## ", 
+        "\n### ",  
+        "\n#### ",  
+        "\n\n",  
+        "\n",  
+        ". ",  
+        "; ",  
+        ", ",  
+        " ",  
+        ""  
+    ]
+)
+
+
+def iter_chunks(pages: List[Dict[str, Any]], filename: str, file_hash: str) -> Iterator[Tuple[Document, List[Document]]]:
+    """Yield each parent with its children as soon as the parent is built."""
+    for parent in _iter_parents(pages, filename, file_hash):
+        yield parent, _split_children(parent)
 
 def create_parent_chunks(pages: List[Dict[str, Any]], filename: str, file_hash: str) -> List[Document]:
     
-    parents = []
+    parents = list(_iter_parents(pages, filename, file_hash))
+    print(f"[INFO] Created {len(parents)} parent chunks (with component_type metadata)")
+    return parents
+
+def _iter_parents(pages: List[Dict[str, Any]], filename: str, file_hash: str) -> Iterator[Document]:
+    
     parent_id_counter = 0
     
-    full_text = "\n\n".join([p["text"] for p in pages])
+    full_text = "\n\n".join(p["text"] for p in pages)
     vehicle_model = detect_vehicle_model(filename)
     sections = _split_by_headers(full_text, pages)
     
@@ -23,10 +61,11 @@ def create_parent_chunks(pages: List[Dict[str, Any]], filename: str, file_hash:
         if len(section_text.strip()) < 100:
             continue
         
-        parent_id = f"{file_hash[:8]}_parent_{parent_id_counter}"
+        # Full file hash: these ids are upserted, so a shared prefix would overwrite another manual
+        parent_id = f"{file_hash}_parent_{parent_id_counter}"
         parent_id_counter += 1
         
-        parent_doc = Document(
+        yield Document(
             page_content=section_text,
             metadata={
                 "parent_id": parent_id,
@@ -41,58 +80,54 @@ def create_parent_chunks(pages: List[Dict[str, Any]], filename: str, file_hash:
                 "char_count": len(section_text)
             }
         )
-        parents.append(parent_doc)
-    
-    print(f"[INFO] Created {len(parents)} parent chunks (with component_type metadata)")
-    return parents
 
 def _split_by_headers(text: str, pages: List[Dict[str, Any]] = None) -> List[Tuple[str, str, str, str]]:
     
-    header_pattern = r'^(\d{1,2}\.?\s*)?([A-Z][a-zA-Z\s\-\&]{3,})$'
-    
-    content_to_page = {}
+    # text is the "\n\n"-joined page texts, so page starts are a running sum of their lengths
+    page_starts, page_nums = [], []
     if pages:
+        offset = 0
         for page in pages:
-            page_num = page.get("page_num", 0)
-            page_text = page.get("text", "")
-            for line in page_text.split('\n'):
-                line_stripped = line.strip()
-                if line_stripped:
-                    content_to_page[line_stripped] = page_num
-    
-    lines = text.split('\n')
+            page_starts.append(offset)
+            page_nums.append(page.get("page_num", 0))
+            offset += len(page.get("text", "")) + 2
+    
+    def page_at(pos: int) -> int:
+        return page_nums[bisect_right(page_starts, pos) - 1]
+    
     sections = []
     current_title = "General"
     current_section = []
     current_code = "unknown"
     current_pages = set()
     last_header = ""
+    pos = 0
     
-    for line in lines:
-        line_stripped = line.strip()
-
-        if line_stripped.isdigit():
+    # Headers are found in one regex pass; only the body between them is walked line by line
+    for match in _HEADER_RE.finditer(text):
+        header = match.group(0).strip()
+        if len(header) >= 60:
             continue
         
-        if line_stripped in content_to_page:
-            current_pages.add(content_to_page[line_stripped])
+        _collect_body(text, pos, match.start(), page_at if pages else None, current_section, current_pages)
+        pos = match.end()
+        
+        if pages:
+            current_pages.add(page_at(match.start()))
         
-        match = re.match(header_pattern, line_stripped)
-        if match and len(line_stripped) < 60: 
-            new_title = match.group(2).strip()
-            if new_title == last_header:
-                continue 
-            if current_section:
-                page_str = ",".join(map(str, sorted(current_pages))) if current_pages else "unknown"
-                sections.append((current_title, "\n".join(current_section), current_code, page_str))
-            current_code = match.group(1).strip() if match.group(1) else "unknown"
-            current_title = new_title
-            current_section = []
-            current_pages = set()
-            last_header = new_title
-        else:
-            if line_stripped:
-                current_section.append(line)
+        new_title = match.group(2).strip()
+        if new_title == last_header:
+            continue 
+        if current_section:
+            page_str = ",".join(map(str, sorted(current_pages))) if current_pages else "unknown"
+            sections.append((current_title, "\n".join(current_section), current_code, page_str))
+        current_code = match.group(1).strip() if match.group(1) else "unknown"
+        current_title = new_title
+        current_section = []
+        current_pages = set()
+        last_header = new_title
+    
+    _collect_body(text, pos, len(text), page_at if pages else None, current_section, current_pages)
     
     if current_section:
         page_str = ",".join(map(str, sorted(current_pages))) if current_pages else "unknown"
@@ -100,46 +135,39 @@ def _split_by_headers(text: str, pages: List[Dict[str, Any]] = None) -> List[Tup
     
     return sections
 
+def _collect_body(text: str, start: int, end: int, page_at: Optional[Callable[[int], int]],
+                  section: List[str], section_pages: set):
+    if page_at is None:
+        section.extend(_BODY_LINE_RE.findall(text, start, end))
+        return
+    
+    for match in _BODY_LINE_RE.finditer(text, start, end):
+        section_pages.add(page_at(match.start()))
+        section.append(match.group(0))
+
 def create_child_chunks(parent_docs: List[Document]) -> List[Document]:
     
     children = []
-    
-    child_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=CHILD_CHUNK_SIZE,  
-        chunk_overlap=CHILD_CHUNK_OVERLAP,  
-        separators=[
-            "\n## ", 
-            "\n### ",  
-            "\n#### ",  
-            "\n\n",  
-            "\n",  
-            ". ",  
-            "; ",  
-            ", ",  
-            " ",  
-            ""  
-        ]
-    )
-    
     for parent in parent_docs:
-        parent_id = parent.metadata["parent_id"]
-        child_texts = child_splitter.split_text(parent.page_content)
-        
-        for child_idx, child_text in enumerate(child_texts):
-            child_doc = Document(
-                page_content=child_text,
-                metadata={
-                    **parent.metadata,  
-                    "parent_id": parent_id,
-                    "type": "child",
-                    "child_index": child_idx,
-                    "chunk_id": f"{parent_id}_child_{child_idx}",
-                    "char_count": len(child_text),
-                    "approx_tokens": len(child_text) // 4  
-                }
-            )
-            children.append(child_doc)
+        children.extend(_split_children(parent))
     
     avg_size = sum(len(c.page_content) for c in children) / len(children) if children else 0
     print(f"[INFO] Created {len(children)} child chunks (avg: {avg_size:.0f} chars, ~{avg_size/4:.0f} tokens)")
     return children
+
+def _split_children(parent: Document) -> List[Document]:
+    
+    parent_id = parent.metadata["parent_id"]
+    # Chroma filters children on the parent's fields, so each needs its own flat dict;
+    # copy() clones the shared base in one go instead of re-inserting every key
+    child_base = {**parent.metadata, "type": "child"}
+    
+    children = []
+    for child_idx, child_text in enumerate(_CHILD_SPLITTER.split_text(parent.page_content)):
+        metadata = child_base.copy()
+        metadata["child_index"] = child_idx
+        metadata["chunk_id"] = f"{parent_id}_child_{child_idx}"
+        metadata["char_count"] = len(child_text)
+        metadata["approx_tokens"] = len(child_text) // 4
+        children.append(Document(page_content=child_text, metadata=metadata))
+    return children
@@ -1,23 +1,30 @@
 
+import re
 import fitz  
 from typing import List, Dict, Any
 
-def extract_text_pages(pdf_path: str) -> List[Dict[str, Any]]:
-    doc = fitz.open(pdf_path)
+# File-name keyword -> vehicle model, all matched by one regex scan
+_VEHICLE_MODELS = {
+    "duster": "Dacia Duster",
+    "logan": "Dacia Logan",
+    "sandero": "Dacia Sandero",
+}
+_MODEL_RE = re.compile("|".join(_VEHICLE_MODELS), re.IGNORECASE)
+
+def extract_text_pages(doc: fitz.Document) -> List[Dict[str, Any]]:
+    # In-process on the caller's open handle: worker processes would either be forked from a
+    # server running model and writer threads (deadlock risk) or re-import the app (spawn/forkserver)
     pages = []
     
-    for page_num in range(len(doc)):
-        page = doc[page_num]
-        
-        page_dict = page.get_text("dict", sort=True)
-        blocks = page_dict.get("blocks", [])
-        
+    for page_num, page in enumerate(doc):
+        # (x0, y0, x1, y1, text, block_no, block_type); type 0 is text, 1 is image
         page_text = []
-        for block in blocks:
-            if "lines" not in block:
+        for block in page.get_text("blocks", sort=True):
+            if block[6] != 0:
                 continue
             
-            block_text = _extract_block_text(block)
+            # One line per block, as the header splitter expects
+            block_text = block[4].replace("\n", " ").strip()
             if len(block_text) > 20:  # Filter noise
                 page_text.append(block_text)
         
@@ -27,24 +34,13 @@ def extract_text_pages(pdf_path: str) -> List[Dict[str, Any]]:
             "blocks": len(page_text)
         })
     
-    doc.close()
     print(f"[INFO] Extracted {len(pages)} pages")
     return pages
 
-def _extract_block_text(block: Dict) -> str:
-    spans_text = [
-        span["text"]
-        for line in block.get("lines", [])
-        for span in line.get("spans", [])
-    ]
-    return " ".join(spans_text).strip()
-
 def detect_vehicle_model(filename: str) -> str:
-    filename_lower = filename.lower()
-    if "duster" in filename_lower:
-        return "Dacia Duster"
-    elif "logan" in filename_lower:
-        return "Dacia Logan"
-    elif "sandero" in filename_lower:
-        return "Dacia Sandero"
+    found = {m.lower() for m in _MODEL_RE.findall(filename)}
+    # Table order decides when a file name mentions more than one model
+    for keyword, model in _VEHICLE_MODELS.items():
+        if keyword in found:
+            return model
     return "Dacia General"
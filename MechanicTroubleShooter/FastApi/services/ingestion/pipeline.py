@@ -1,59 +1,103 @@
 import os
-import hashlib
-from typing import Dict, Any, List
+import threading
+from collections import deque
+import fitz
+from typing import Dict, Any, List, Set
+from concurrent.futures import ThreadPoolExecutor
 from langchain_core.documents import Document
 from .pdf_processor import extract_text_pages
-from .chunking import create_parent_chunks, create_child_chunks
-from .vision import process_images
-from services.storage.vector import vector_db
+from .chunking import iter_chunks
+from .vision import process_images, DEFAULT_VISION_CONCURRENCY
+from core.hashing import sha256_file
+from services.storage.vector import vector_db, ADD_BATCH_SIZE
 from services.storage.document import get_docstore
+from services.storage.checkpoint import IngestCheckpoint
 from services.retrieval.hybrid_search import rebuild_bm25_index
 
+# Embedded batches allowed to queue up behind a slow Chroma write
+MAX_PENDING_WRITES = 2
+# Metadata rows fetched per request while collecting indexed file hashes at startup
+HASH_SCAN_PAGE = 5000
+
 class MultimodalIngestionPipeline:
     
-    def __init__(self, persist_dir: str = "./chroma_db"):
+    def __init__(self, persist_dir: str = "./chroma_db", vision_concurrency: int = DEFAULT_VISION_CONCURRENCY):
         self.persist_dir = persist_dir
+        self.vision_concurrency = vision_concurrency
         os.makedirs(persist_dir, exist_ok=True)
         self.docstore = get_docstore()
         self.vectorstore = vector_db
-        print(f"[INFO] Pipeline initialized ({persist_dir})")
+        # (path, size, mtime) -> sha256, so unchanged files are only ever hashed once
+        self._hash_memo: Dict[tuple, str] = {}
+        self.checkpoint = IngestCheckpoint(os.path.join(persist_dir, ".ingest_ckpt.json"))
+        # Held for a whole ingest: the hash sets, checkpoint file and BM25 index are shared state
+        self._ingest_lock = threading.Lock()
+        # One metadata scan up front so duplicate checks never hit Chroma; files that
+        # crashed before all their vectors were written are not indexed, whatever Chroma holds
+        self._indexed_hashes = self._load_indexed_hashes() - {
+            h for h in self.checkpoint.unfinished() if not self.checkpoint.has(h, "vectors")
+        }
+        print(f"[INFO] Pipeline initialized ({persist_dir}, {len(self._indexed_hashes)} files indexed)")
     
     def ingest_pdf(self, pdf_path: str, force: bool = False) -> Dict[str, Any]:
+        # /ingest handlers run in the threadpool, so concurrent uploads are queued here
+        with self._ingest_lock:
+            return self._ingest_pdf(pdf_path, force)
+
+    def _ingest_pdf(self, pdf_path: str, force: bool) -> Dict[str, Any]:
         filename = os.path.basename(pdf_path)
         print(f"\n[INFO] Processing: {filename}")
         
-        file_hash = self._compute_file_hash(pdf_path)
-        if not force and self._is_document_indexed(file_hash):
-            print(f"[INFO] Skipping {filename} (Already Indexed)")
-            return {"status": "skipped", "reason": "duplicate_hash"}
+        hash_future = None
+        if force:
+            # Nothing waits on the dedup check, so hash while the text is being extracted
+            hasher = ThreadPoolExecutor(max_workers=1)
+            hash_future = hasher.submit(self._compute_file_hash, pdf_path)
+            hasher.shutdown(wait=False)
+        else:
+            file_hash = self._compute_file_hash(pdf_path)
+            if self._is_document_indexed(file_hash):
+                print(f"[INFO] Skipping {filename} (Already Indexed)")
+                return {"status": "skipped", "reason": "duplicate_hash"}
         
         try:
-            text_pages = extract_text_pages(pdf_path)
+            # Parsed once: text extraction and image extraction share the handle
+            with fitz.open(pdf_path) as doc:
+                text_pages = extract_text_pages(doc)
+                if hash_future is not None:
+                    file_hash = hash_future.result()
+                if force and self._is_document_indexed(file_hash):
+                    # Replaced wholesale: copies written under an older id scheme would not be
+                    # overwritten by the upsert and would stay as duplicates
+                    self._discard_partial(file_hash)
+                self._start_checkpoint(file_hash, filename)
+                image_docs = process_images(doc, filename, file_hash, max_workers=self.vision_concurrency)
             print(f"[DEBUG] Extracted {len(text_pages)} text pages")
             
-            parent_docs = create_parent_chunks(text_pages, filename, file_hash)
-            print(f"[DEBUG] Created {len(parent_docs) if parent_docs else 0} parent docs")
-            
-            child_docs = create_child_chunks(parent_docs)
-            print(f"[DEBUG] child_docs type: {type(child_docs)}, count: {len(child_docs) if child_docs else 'None'}")
+            # Parents go to the docstore as they are chunked, so they persist while the rest is split
+            parent_count = 0
+            child_docs = []
+            for parent, children in iter_chunks(text_pages, filename, file_hash):
+                self.docstore.add_document(parent.metadata["parent_id"], parent)
+                parent_count += 1
+                child_docs.extend(children)
+            print(f"[DEBUG] Created {parent_count} parent docs, {len(child_docs)} child docs")
             
-            image_docs = process_images(pdf_path, filename, file_hash)
             print(f"[DEBUG] image_docs type: {type(image_docs)}, count: {len(image_docs) if image_docs else 'None'}")
             
-            if child_docs is None:
-                child_docs = []
-                print("[WARNING] child_docs was None, using empty list")
             if image_docs is None:
                 image_docs = []
                 print("[WARNING] image_docs was None, using empty list")
             
-            self._store_documents(parent_docs, child_docs, image_docs)
+            self._store_documents(child_docs, image_docs, file_hash)
+            self._indexed_hashes.add(file_hash)
+            self.checkpoint.clear(file_hash)
             
-            print(f"[INFO] Ingestion complete (P:{len(parent_docs)}, C:{len(child_docs)}, I:{len(image_docs)})")
+            print(f"[INFO] Ingestion complete (P:{parent_count}, C:{len(child_docs)}, I:{len(image_docs)})")
             
             return {
                 "status": "success",
-                "parents": len(parent_docs),
+                "parents": parent_count,
                 "children": len(child_docs),
                 "images_captioned": len(image_docs)
             }
@@ -61,21 +105,19 @@ class MultimodalIngestionPipeline:
         except Exception as e:
             import traceback
             traceback.print_exc()
+            # Some parents or vectors may have been written before the failure
+            self.docstore.bump_corpus_version()
             return {"status": "error", "error": str(e)}
 
-    def _store_documents(self, parents: List[Document], children: List[Document], images: List[Document]):
-        for parent in parents:
-            self.docstore.add_document(parent.metadata["parent_id"], parent)
-        
+    def _store_documents(self, children: List[Document], images: List[Document], file_hash: str):
         all_children = children + images
         
         if all_children:
-            BATCH_SIZE = 5000  
+            batches = -(-len(all_children) // ADD_BATCH_SIZE)
+            print(f"[INFO] Adding {len(all_children)} documents in {batches} batches of {ADD_BATCH_SIZE}")
             
-            for i in range(0, len(all_children), BATCH_SIZE):
-                batch = all_children[i:i + BATCH_SIZE]
-                print(f"[INFO] Adding batch {i//BATCH_SIZE + 1} ({len(batch)} documents)")
-                self.vectorstore.add_documents(batch)
+            self._add_to_vectorstore(all_children)
+            self.checkpoint.mark(file_hash, "vectors")
             
             print(f"[INFO] Successfully added {len(all_children)} documents to vector store")
             
@@ -84,6 +126,54 @@ class MultimodalIngestionPipeline:
                 rebuild_bm25_index(children)  
             except Exception as e:
                 print(f"[WARN] BM25 index rebuild failed: {e}")
+        
+        # Parents were persisted in the background while children were embedded
+        self.docstore.flush()
+        # Covers image-only changes too, which never touch the docstore
+        self.docstore.bump_corpus_version()
+
+    def _start_checkpoint(self, file_hash: str, filename: str):
+        # Only "started" and "vectors" are tracked: a resumed file is always redone from scratch
+        if self.checkpoint.has(file_hash, "started"):
+            # Captions already generated come back from the caption cache, so only
+            # the images that never finished go to the vision model again
+            print(f"[INFO] Resuming interrupted ingest of {filename}")
+            self._discard_partial(file_hash)
+        self.checkpoint.mark(file_hash, "started")
+
+    def _discard_partial(self, file_hash: str):
+        # Not indexed any more until this run stores it again, even if the run fails
+        self._indexed_hashes.discard(file_hash)
+        try:
+            self.vectorstore._collection.delete(where={"file_hash": file_hash})
+        except Exception as e:
+            print(f"[WARN] Could not remove partial vectors: {e}")
+        self.docstore.delete_by_file_hash(file_hash)
+
+    def _add_to_vectorstore(self, docs: List[Document]):
+        # Embed each batch ourselves and hand Chroma the vectors, so embedding keeps going
+        # while earlier batches are written; at most MAX_PENDING_WRITES batches wait in memory
+        embeddings = self.vectorstore.embeddings
+        collection = self.vectorstore._collection
+        
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            pending = deque()
+            for i in range(0, len(docs), ADD_BATCH_SIZE):
+                batch = docs[i:i + ADD_BATCH_SIZE]
+                texts = [doc.page_content for doc in batch]
+                vectors = embeddings.embed_documents(texts)
+                
+                if len(pending) >= MAX_PENDING_WRITES:
+                    pending.popleft().result()
+                pending.append(writer.submit(
+                    collection.upsert,
+                    ids=[_vector_id(doc) for doc in batch],
+                    embeddings=vectors,
+                    documents=texts,
+                    metadatas=[doc.metadata for doc in batch]
+                ))
+            while pending:
+                pending.popleft().result()
 
     def get_stats(self) -> Dict[str, Any]:
         try:
@@ -96,15 +186,38 @@ class MultimodalIngestionPipeline:
             return {"children_count": 0, "parents_count": 0}
 
     def _compute_file_hash(self, file_path: str) -> str:
-        sha = hashlib.sha256()
-        with open(file_path, "rb") as f:
-            for b in iter(lambda: f.read(4096), b""):
-                sha.update(b)
-        return sha.hexdigest()
+        st = os.stat(file_path)
+        key = (os.path.realpath(file_path), st.st_size, st.st_mtime_ns)
+        if key in self._hash_memo:
+            return self._hash_memo[key]
+        
+        digest = sha256_file(file_path)
+        self._hash_memo[key] = digest
+        return digest
     
-    def _is_document_indexed(self, file_hash: str) -> bool:
+    def _load_indexed_hashes(self) -> Set[str]:
+        # Paged, so a large collection never has all of its metadata in memory at once
+        hashes = set()
         try:
-            res = self.vectorstore.get(where={"file_hash": file_hash}, limit=1)
-            return bool(res and res['ids'])
-        except:
-            return False
\ No newline at end of file
+            offset = 0
+            while True:
+                res = self.vectorstore._collection.get(include=['metadatas'], limit=HASH_SCAN_PAGE, offset=offset)
+                hashes.update(m['file_hash'] for m in res['metadatas'] if m and 'file_hash' in m)
+                if len(res['ids']) < HASH_SCAN_PAGE:
+                    return hashes
+                offset += HASH_SCAN_PAGE
+        except Exception as e:
+            print(f"[WARN] Could not load indexed hashes: {e}")
+            return set()
+    
+    def reset_indexed_hashes(self):
+        self._indexed_hashes.clear()
+    
+    def _is_document_indexed(self, file_hash: str) -> bool:
+        return file_hash in self._indexed_hashes
+
+
+def _vector_id(doc: Document) -> str:
+    # Stable per chunk (children have chunk_id, each image its own parent_id), so a forced
+    # re-ingest overwrites the file's vectors instead of adding a second copy
+    return doc.metadata.get("chunk_id") or doc.metadata["parent_id"]
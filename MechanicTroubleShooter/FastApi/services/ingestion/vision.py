@@ -1,58 +1,50 @@
 
 import os
 import fitz
+import hashlib
 from typing import List
 from langchain_core.documents import Document
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from core.config import OLLAMA_NUM_PARALLEL
 from services.llm.client import describe_image
 from .pdf_processor import detect_vehicle_model
 
-def process_images(pdf_path: str, filename: str, file_hash: str) -> List[Document]:
-    doc = fitz.open(pdf_path)
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+    print("[INFO] xxhash not installed, image fingerprints use blake2b. Run: pip install xxhash")
+
+# Two requests per Ollama slot: one generating, one uploaded and queued behind it.
+# More than that just parks base64 payloads inside Ollama's queue
+DEFAULT_VISION_CONCURRENCY = 2 * OLLAMA_NUM_PARALLEL
+# Captions waiting to be collected; submission pauses once this many are outstanding
+MAX_IN_FLIGHT = 32
+# Smaller than this (width x height) is a logo, bullet or rule: rejected before decoding
+MIN_IMAGE_PIXELS = 100 * 100
+# Images under this many bytes carry too little detail to caption
+MIN_IMAGE_BYTES = 5 * 1024
+
+def process_images(doc: fitz.Document, filename: str, file_hash: str,
+                   max_workers: int = DEFAULT_VISION_CONCURRENCY) -> List[Document]:
     image_docs = []
     image_dir = "static/images"
     os.makedirs(image_dir, exist_ok=True)
+    base_name = os.path.splitext(filename)[0]
+    vehicle_model = detect_vehicle_model(filename)
     
-    tasks = []
-    
-    for page_num in range(len(doc)):
-        page = doc[page_num]
-        image_list = page.get_images(full=True)
-        
-        for img_idx, img in enumerate(image_list):
-            try:
-                xref = img[0]
-                base_image = doc.extract_image(xref)
-                image_bytes = base_image["image"]
-                ext = base_image["ext"]
-                
-                if len(image_bytes) < 5 * 1024:
-                    continue
-                
-                base_name = os.path.splitext(filename)[0]
-                image_filename = f"{base_name}_p{page_num+1}_i{img_idx}.{ext}"
-                image_path = os.path.join(image_dir, image_filename)
-                
-                with open(image_path, "wb") as f:
-                    f.write(image_bytes)
-                    
-                tasks.append({
-                    "path": image_path, "page": page_num + 1, "img_idx": img_idx,
-                    "size_kb": round(len(image_bytes) / 1024, 2)
-                })
-            except Exception as e:
-                print(f"[WARN] Failed to extract image on page {page_num+1}: {e}")
-    
-    doc.close()
-    if not tasks:
-        print("[INFO] No valid images found")
-        return []
-
-    print(f"[INFO] Captioning {len(tasks)} images...")
+    # A logo or diagram used on many pages is one xref: extract and fingerprint it once.
+    # Only (ext, fingerprint, size_kb) is kept; bytes live only while their caption is in flight
+    extracted = {}
+    # Icons and diagrams repeat across pages: caption each distinct image once
+    captions = {}
+    seen_fingerprints = set()
+    duplicates = []
 
-    def process_single(task):
-        caption = describe_image(task["path"], task["page"])
-        parent_id = f"{file_hash[:8]}_image_{task['page']-1}_{task['img_idx']}"
+    def build_doc(task, caption, image_bytes):
+        with open(task["path"], "wb") as f:
+            f.write(image_bytes)
+        parent_id = f"{file_hash}_image_{task['page']-1}_{task['img_idx']}"
         return Document(
             page_content=caption,
             metadata={
@@ -62,18 +54,104 @@ def process_images(pdf_path: str, filename: str, file_hash: str) -> List[Documen
                 "file_hash": file_hash,
                 "page": task["page"],
                 "image_path": task["path"],
-                "vehicle_model": detect_vehicle_model(filename)
+                "vehicle_model": vehicle_model
             }
         )
 
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        futures = [executor.submit(process_single, t) for t in tasks]
-        for future in as_completed(futures):
+    def process_single(task, image_bytes):
+        # Bytes go straight to the vision model; the file is written once captioned
+        caption = describe_image(page_num=task["page"], image_bytes=image_bytes)
+        captions[task["fingerprint"]] = (caption, task["page"])
+        return build_doc(task, caption, image_bytes)
+
+    def collect(done):
+        for future in done:
             try:
-                doc = future.result()
-                image_docs.append(doc)
+                image_docs.append(future.result())
             except Exception as e:
                 print(f"[ERROR] Image processing failed: {e}")
 
-    print(f"[INFO] Processed {len(image_docs)} images")
+    # PyMuPDF is only touched from this thread; workers get the bytes of the one image they caption
+    workers = max(1, max_workers)
+    max_in_flight = max(MAX_IN_FLIGHT, workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for page_num in range(len(doc)):
+            page = doc[page_num]
+            image_list = page.get_images(full=True)
+            
+            for img_idx, img in enumerate(image_list):
+                try:
+                    # (xref, smask, width, height, bpc, colorspace, ...) is read without decoding
+                    xref, _, width, height = img[:4]
+                    if width * height < MIN_IMAGE_PIXELS:
+                        continue
+                    
+                    image_bytes = None
+                    if xref not in extracted:
+                        image_bytes, extracted[xref] = _extract(doc, xref)
+                    ext, fingerprint, size_kb = extracted[xref]
+                    
+                    if fingerprint is None:  # under MIN_IMAGE_BYTES
+                        continue
+                    
+                    image_filename = f"{base_name}_p{page_num+1}_i{img_idx}.{ext}"
+                    task = {
+                        "path": os.path.join(image_dir, image_filename), "page": page_num + 1,
+                        "img_idx": img_idx, "xref": xref, "size_kb": size_kb, "fingerprint": fingerprint
+                    }
+                    if fingerprint in seen_fingerprints:
+                        duplicates.append(task)
+                        continue
+                    seen_fingerprints.add(fingerprint)
+                    
+                    if len(pending) >= max_in_flight:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        collect(done)
+                    pending.add(executor.submit(process_single, task, image_bytes))
+                except Exception as e:
+                    print(f"[WARN] Failed to extract image on page {page_num+1}: {e}")
+        collect(wait(pending)[0])
+
+    if not seen_fingerprints:
+        print("[INFO] No valid images found")
+        return []
+
+    # Grouped by xref, so an image repeated on many pages is decoded once more, not once per page
+    last_xref, last_bytes = None, None
+    for task in sorted(duplicates, key=lambda t: t["xref"]):
+        if task["fingerprint"] not in captions:
+            continue
+        caption, captioned_page = captions[task["fingerprint"]]
+        try:
+            if task["xref"] != last_xref:
+                last_xref, last_bytes = task["xref"], doc.extract_image(task["xref"])["image"]
+            image_docs.append(build_doc(task, _repage_caption(caption, captioned_page, task["page"]), last_bytes))
+        except Exception as e:
+            print(f"[ERROR] Image processing failed: {e}")
+
+    print(f"[INFO] Processed {len(image_docs)} images ({len(duplicates)} duplicates reused a caption)")
     return image_docs
+
+
+def _extract(doc: fitz.Document, xref: int):
+    base_image = doc.extract_image(xref)
+    image_bytes = base_image["image"]
+    if len(image_bytes) < MIN_IMAGE_BYTES:
+        return None, (base_image["ext"], None, None)
+    return image_bytes, (base_image["ext"], _image_fingerprint(image_bytes), round(len(image_bytes) / 1024, 2))
+
+
+def _image_fingerprint(image_bytes: bytes) -> str:
+    # Only dedups images within one ingest, so a fast non-cryptographic hash is enough
+    if xxhash is not None:
+        return xxhash.xxh3_128_hexdigest(image_bytes)
+    return hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+
+
+def _repage_caption(caption: str, from_page: int, to_page: int) -> str:
+    # Captions end with "(Page N)" for the page they were generated on
+    suffix = f"(Page {from_page})"
+    if from_page != to_page and caption.endswith(suffix):
+        return f"{caption[:-len(suffix)]}(Page {to_page})"
+    return caption
@@ -1,39 +1,155 @@
 import requests
+from requests.adapters import HTTPAdapter
 import base64
 import os
 import json
 import hashlib
 import re
+import sqlite3
+import threading
+import time
+from typing import Callable, Optional
 
 from core.config import OLLAMA_URL, TEXT_MODEL, VISION_MODEL
+from core.hashing import sha256_file
+
+CACHE_DB = "./chroma_db/image_captions_cache.sqlite3"
+# Pre-SQLite cache, imported into CACHE_DB the first time it is created
+LEGACY_CACHE_FILE = "./chroma_db/image_captions_cache.json"
+
+# Connect, then the wait for the first token: covers loading a cold model and a slow CPU image prefill
+OLLAMA_TIMEOUT = (5, 120)
+# Once a response is streaming, the longest allowed gap between tokens
+OLLAMA_TOKEN_TIMEOUT = 30
+# Warmup waits for the whole (one-token) response; it runs in the background, so a cold load may take its time
+OLLAMA_WARMUP_TIMEOUT = (5, 300)
+
+# Keep-alive connections to Ollama, shared by every captioning and chat thread
+_SESSION = requests.Session()
+_SESSION.mount("http://", HTTPAdapter(pool_connections=8, pool_maxsize=32))
+
+# Opened once, then shared by every captioning thread (the lock serializes use of the connection)
+_CACHE_CONN: Optional[sqlite3.Connection] = None
+_CACHE_LOCK = threading.Lock()
+
+# Ollama keeps a model loaded for 5 minutes after its last request (default keep_alive);
+# a chat model used more recently than this needs no warmup
+CHAT_MODEL_WARM_SECONDS = 240
+_chat_model_used_at = 0.0
+_warmup_lock = threading.Lock()
+
+_YES_RE = re.compile(r"YES", re.IGNORECASE)
+_CAPTION_FIELD_RE = re.compile(r"^\s*(category|components|description):(.*)$", re.IGNORECASE | re.MULTILINE)
+
+# OCR/PDF artifact fixes applied to every chat context, compiled once
+_CONTRACTION_RE = re.compile(r"(\w)\s+'(\w)")
+_HYPHEN_RE = re.compile(r'\s*-\s*')
+_SPLIT_CAPITAL_RE = re.compile(r'\b([A-Z])\s+([a-z])')
+_SPLIT_SUFFIX_RE = re.compile(r'(\w{2,})\s+([a-z]{2,}(?:tion|ment|ing|ness|able|ible|ure|ous|ive|ect|oot|ose|age|ance|ence))\b')
+_SPLIT_ABBREV_RE = re.compile(r'O\s*B\s*D|A\s*B\s*S|E\s*S\s*P|E\s*C\s*U|D\s*T\s*C')
+_MULTI_SPACE_RE = re.compile(r'  +')
+_SPACE_BEFORE_PUNCT_RE = re.compile(r'\s+([.,!?;:])')
+
+_IMAGE_CAPTION_PROMPT = """Analyze this automotive manual image and provide a structured description.
 
-CACHE_FILE = "./chroma_db/image_captions_cache.json"
+FORMAT YOUR RESPONSE EXACTLY AS:
+CATEGORY: [One of: engine, transmission, brakes, suspension, electrical, dashboard, interior, exterior, body, wheels, steering, exhaust, cooling, fuel system, climate control, airbags, sensors, wiring, diagram, other]
+COMPONENTS: [List the main visible components/parts, comma-separated]
+DESCRIPTION: [One sentence describing what this image shows and its purpose]
+
+Be specific about automotive systems. If it's a diagram, identify what system it documents.
+If it shows the dashboard or interior, specify what controls or features are visible.
+If it shows an engine or mechanical parts, name the specific components."""
+
+_IMAGE_RELEVANCE_PROMPT = """You are evaluating whether an image is relevant to a user's query.
+
+- Answer YES only if the image shows exactly what the user is asking about
+- Answer NO if the image is about a different topic or unrelated system
+- Be strict: a dashboard image is NOT relevant to an engine question
 
+USER QUERY: {}
+
+IMAGE DESCRIPTION: {}
+
+Is this image DIRECTLY relevant and useful for answering the user's query?
+Answer with ONLY "YES" or "NO"."""
+
+# Static instructions lead every prompt so Ollama can reuse their KV cache across requests;
+# only the tail after the first placeholder is prefilled again
+_RAG_PROMPT = """You are a Dacia workshop technician. Answer ONLY using the CONTEXT from the official manual.
+
+RULES:
+1. Use ONLY information present in CONTEXT.
+2. Do NOT guess causes unless mentioned in CONTEXT.
+3. If unsure, say "the manual does not specify this".
+4. Reference previous conversation when relevant.
+5. If CONTEXT contains image descriptions (marked as "image" sources), reference them naturally. The images WILL be displayed to the user alongside your response, so you can say "As shown in the image below" or "The diagram shows...".
+{}
+CONTEXT:
+{}
 
-def call_ollama(prompt: str, model: str = None, image_path: str = None) -> str:
+QUESTION:
+{}
+
+ANSWER:
+"""
+
+
+def call_ollama(prompt: str, model: str = None, image_path: str = None, image_bytes: bytes = None) -> str:
     model = model or TEXT_MODEL
     
     payload = {
         "model": model,
         "prompt": prompt,
-        "stream": False,
+        "stream": True,
         "options": {"temperature": 0.1, "num_ctx": 4096}
     }
 
-    if image_path and os.path.exists(image_path):
+    if image_bytes is not None:
+        payload["images"] = [base64.b64encode(image_bytes).decode('utf-8')]
+    elif image_path and os.path.exists(image_path):
         with open(image_path, "rb") as f:
             payload["images"] = [base64.b64encode(f.read()).decode('utf-8')]
 
     try:
-        resp = requests.post(OLLAMA_URL, json=payload, timeout=60)
-        resp.raise_for_status()
-        return resp.json().get("response", "").strip()
+        # Streamed so a stalled model is dropped after one token gap, not a whole-response timeout
+        parts = []
+        with _SESSION.post(OLLAMA_URL, json=payload, stream=True, timeout=OLLAMA_TIMEOUT) as resp:
+            resp.raise_for_status()
+            _mark_model_used(model)
+            for line in resp.iter_lines():
+                if line:
+                    chunk = _parse_chunk(line, resp, first=not parts)
+                    parts.append(chunk.get("response", ""))
+                    if chunk.get("done", False):
+                        break
+        return "".join(parts).strip()
     except Exception as e:
         print(f"[ERROR] Ollama failed: {e}")
         return f"Error: {str(e)}"
 
 
-def stream_ollama(prompt: str, model: str = None):
+def _parse_chunk(line: bytes, resp: requests.Response, first: bool) -> dict:
+    chunk = json.loads(line)
+    # Ollama reports failures after the 200 header (model not found, out of memory...)
+    if "error" in chunk:
+        raise RuntimeError(f"Ollama error: {chunk['error']}")
+    if first:
+        # The slow start is over: from here on, a stall means a dead stream.
+        # Best effort; urllib3 resets the socket timeout when the connection is reused
+        try:
+            resp.raw._connection.sock.settimeout(OLLAMA_TOKEN_TIMEOUT)
+        except (AttributeError, OSError):
+            pass
+    return chunk
+
+
+def stream_ollama(prompt: str, model: str = None, stop_after: Optional[Callable[[str], bool]] = None):
+    """
+    Yield response tokens as Ollama generates them.
+    If stop_after is given, it is called with the text received so far and the
+    stream is closed (aborting generation) as soon as it returns True.
+    """
     model = model or TEXT_MODEL
     
     payload = {
@@ -43,66 +159,61 @@ def stream_ollama(prompt: str, model: str = None):
         "options": {"temperature": 0.1, "num_ctx": 4096}
     }
 
+    received = ""
+    first = True
     try:
-        with requests.post(OLLAMA_URL, json=payload, stream=True, timeout=120) as resp:
+        with _SESSION.post(OLLAMA_URL, json=payload, stream=True, timeout=OLLAMA_TIMEOUT) as resp:
             resp.raise_for_status()
+            _mark_model_used(model)
             for line in resp.iter_lines():
                 if line:
-                    chunk = json.loads(line)
+                    chunk = _parse_chunk(line, resp, first)
+                    first = False
                     token = chunk.get("response", "")
                     if token:
                         yield token
                     if chunk.get("done", False):
                         break
+                    if stop_after and token:
+                        received += token
+                        if stop_after(received):
+                            break
     except Exception as e:
         print(f"[ERROR] Streaming failed: {e}")
         yield f"Error: {str(e)}"
 
 
-def describe_image(image_path: str, page_num: int = None) -> str:
-    file_hash = _get_file_hash(image_path)
-    cache = _load_cache()
-    
-    if file_hash in cache:
-        print(f"[VISION] Cache hit: {os.path.basename(image_path)}")
-        return cache[file_hash]
-
-    prompt = """Analyze this automotive manual image and provide a structured description.
-
-FORMAT YOUR RESPONSE EXACTLY AS:
-CATEGORY: [One of: engine, transmission, brakes, suspension, electrical, dashboard, interior, exterior, body, wheels, steering, exhaust, cooling, fuel system, climate control, airbags, sensors, wiring, diagram, other]
-COMPONENTS: [List the main visible components/parts, comma-separated]
-DESCRIPTION: [One sentence describing what this image shows and its purpose]
-
-Be specific about automotive systems. If it's a diagram, identify what system it documents.
-If it shows the dashboard or interior, specify what controls or features are visible.
-If it shows an engine or mechanical parts, name the specific components."""
+def describe_image(image_path: str = None, page_num: int = None, image_bytes: bytes = None) -> str:
+    """Caption an image given either its file path or its raw bytes."""
+    if image_bytes is not None:
+        # Same key as hashing the file, so cached captions stay valid
+        file_hash = hashlib.sha256(image_bytes).hexdigest()
+    else:
+        file_hash = _get_file_hash(image_path)
+    cached = _cache_get(file_hash)
+    if cached is not None:
+        print(f"[VISION] Cache hit: {os.path.basename(image_path) if image_path else file_hash[:12]}")
+        return cached
 
-    result = call_ollama(prompt, model=VISION_MODEL, image_path=image_path)
+    result = call_ollama(_IMAGE_CAPTION_PROMPT, model=VISION_MODEL, image_path=image_path, image_bytes=image_bytes)
     
     formatted = _format_image_caption(result, page_num)
     
-    cache[file_hash] = formatted
-    _save_cache(cache)
+    # call_ollama reports failures as an "Error: ..." string; never cache those (or an empty
+    # caption), so the image is captioned for real next time instead of keeping the error forever
+    if result and not result.startswith("Error:"):
+        _cache_put(file_hash, formatted)
     return formatted
 
 
 def _format_image_caption(raw_result: str, page_num: int = None) -> str:
     """Format vision model output into a searchable caption."""
-    lines = raw_result.strip().split('\n')
+    fields = {"category": "automotive", "components": "", "description": raw_result}
     
-    category = "automotive"
-    components = ""
-    description = raw_result  
-    
-    for line in lines:
-        line_lower = line.lower().strip()
-        if line_lower.startswith('category:'):
-            category = line.split(':', 1)[1].strip()
-        elif line_lower.startswith('components:'):
-            components = line.split(':', 1)[1].strip()
-        elif line_lower.startswith('description:'):
-            description = line.split(':', 1)[1].strip()
+    # One scan for all three labelled lines; a later line wins, as before
+    for match in _CAPTION_FIELD_RE.finditer(raw_result.strip()):
+        fields[match.group(1).lower()] = match.group(2).strip()
+    category, components, description = fields["category"], fields["components"], fields["description"]
     
     # Build searchable caption
     parts = []
@@ -121,22 +232,12 @@ def evaluate_image_relevance(query: str, image_caption: str) -> bool:
     Ask the LLM to evaluate if an image is relevant to the user's query.
     Returns True if relevant, False otherwise.
     """
-    prompt = f"""You are evaluating whether an image is relevant to a user's query.
-
-USER QUERY: {query}
-
-IMAGE DESCRIPTION: {image_caption}
-
-Is this image DIRECTLY relevant and useful for answering the user's query?
-Answer with ONLY "YES" or "NO".
-
-- Answer YES only if the image shows exactly what the user is asking about
-- Answer NO if the image is about a different topic or unrelated system
-- Be strict: a dashboard image is NOT relevant to an engine question"""
+    prompt = _IMAGE_RELEVANCE_PROMPT.format(query, image_caption)
 
     try:
-        response = call_ollama(prompt).strip().upper()
-        is_relevant = response.startswith("YES")
+        # The verdict is the first word; stop generating once it has arrived
+        response = "".join(stream_ollama(prompt, stop_after=_has_verdict)).strip()
+        is_relevant = _YES_RE.match(response) is not None
         print(f"[LLM] Image relevance: {response} for '{image_caption[:50]}...'")
         return is_relevant
     except Exception as e:
@@ -144,6 +245,10 @@ Answer with ONLY "YES" or "NO".
         return False  # Default to not showing if evaluation fails
 
 
+def _has_verdict(text: str) -> bool:
+    return len(text.lstrip()) >= 3
+
+
 def generate_chat_answer(context: str, question: str, history: list = None) -> str:
     prompt = _build_rag_prompt(context, question, history)
     return call_ollama(prompt)
@@ -154,6 +259,40 @@ def stream_chat_answer(context: str, question: str, history: list = None):
     yield from stream_ollama(prompt)
 
 
+def _mark_model_used(model: str):
+    global _chat_model_used_at
+    if model == TEXT_MODEL:
+        _chat_model_used_at = time.monotonic()
+
+
+def warmup_chat_model():
+    """
+    Prefill the static RAG rules while retrieval is still running, so the model is
+    loaded and the prompt prefix is in Ollama's KV cache when the real request arrives.
+    Skipped when the model served a request recently or another warmup is in flight,
+    so concurrent chats don't spend Ollama slots on it.
+    """
+    if time.monotonic() - _chat_model_used_at < CHAT_MODEL_WARM_SECONDS:
+        return
+    if not _warmup_lock.acquire(blocking=False):
+        return
+    
+    payload = {
+        "model": TEXT_MODEL,
+        "prompt": _RAG_PROMPT.split("{}", 1)[0],
+        "stream": False,
+        # Same num_ctx as the real request, or Ollama reloads the model to resize it
+        "options": {"temperature": 0.1, "num_ctx": 4096, "num_predict": 1}
+    }
+    try:
+        _SESSION.post(OLLAMA_URL, json=payload, timeout=OLLAMA_WARMUP_TIMEOUT).raise_for_status()
+        _mark_model_used(TEXT_MODEL)
+    except Exception as e:
+        print(f"[WARN] Chat model warmup failed: {e}")
+    finally:
+        _warmup_lock.release()
+
+
 def _build_rag_prompt(context: str, question: str, history: list = None) -> str:
     # Clean OCR artifacts from context at runtime
     context = _clean_text(context)
@@ -166,46 +305,58 @@ def _build_rag_prompt(context: str, question: str, history: list = None) -> str:
         ])
         history_text = f"\nCONVERSATION HISTORY:\n{history_text}\n"
 
-    return f"""You are a Dacia workshop technician. Answer ONLY using the CONTEXT from the official manual.
-{history_text}
-CONTEXT:
-{context}
+    return _RAG_PROMPT.format(history_text, context, question)
+
+def _cache_conn() -> sqlite3.Connection:
+    # Caller holds _CACHE_LOCK
+    global _CACHE_CONN
+    if _CACHE_CONN is None:
+        is_new = not os.path.exists(CACHE_DB)
+        conn = sqlite3.connect(CACHE_DB, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS captions (hash TEXT PRIMARY KEY, caption TEXT NOT NULL)")
+        if is_new:
+            _import_legacy_cache(conn)
+        conn.commit()
+        _CACHE_CONN = conn
+    return _CACHE_CONN
+
+
+def _import_legacy_cache(conn: sqlite3.Connection):
+    if not os.path.exists(LEGACY_CACHE_FILE):
+        return
+    try:
+        with open(LEGACY_CACHE_FILE, 'r') as f:
+            legacy = json.load(f)
+        conn.executemany("INSERT OR IGNORE INTO captions VALUES (?, ?)", legacy.items())
+        print(f"[VISION] Imported {len(legacy)} cached captions from {LEGACY_CACHE_FILE}")
+    except Exception as e:
+        print(f"[WARN] Could not import legacy caption cache: {e}")
 
-QUESTION:
-{question}
 
-RULES:
-1. Use ONLY information present in CONTEXT.
-2. Do NOT guess causes unless mentioned in CONTEXT.
-3. If unsure, say "the manual does not specify this".
-4. Reference previous conversation when relevant.
-5. If CONTEXT contains image descriptions (marked as "image" sources), reference them naturally. The images WILL be displayed to the user alongside your response, so you can say "As shown in the image below" or "The diagram shows...".
-
-ANSWER:
-"""
-def _load_cache():
-    if os.path.exists(CACHE_FILE):
-        try:
-            with open(CACHE_FILE, 'r') as f:
-                return json.load(f)
-        except:
-            return {}
-    return {}
+def _cache_get(file_hash: str) -> Optional[str]:
+    try:
+        with _CACHE_LOCK:
+            row = _cache_conn().execute("SELECT caption FROM captions WHERE hash = ?", (file_hash,)).fetchone()
+        return row[0] if row else None
+    except Exception as e:
+        print(f"[WARN] Caption cache lookup failed: {e}")
+        return None
 
 
-def _save_cache(cache):
+def _cache_put(file_hash: str, caption: str):
     try:
-        with open(CACHE_FILE, 'w') as f:
-            json.dump(cache, f)
-    except:
-        pass
+        with _CACHE_LOCK:
+            conn = _cache_conn()
+            conn.execute("INSERT OR REPLACE INTO captions VALUES (?, ?)", (file_hash, caption))
+            conn.commit()
+    except Exception as e:
+        print(f"[WARN] Failed to save caption: {e}")
 
 
 def _get_file_hash(path):
-    h = hashlib.sha256()
-    with open(path, "rb") as f:
-        h.update(f.read())
-    return h.hexdigest()
+    # Only used when a caller passes a path; process_images hands over the bytes it already holds
+    return sha256_file(path)
 
 
 def _clean_text(text: str) -> str:
@@ -217,30 +368,24 @@ def _clean_text(text: str) -> str:
         return text
     
     # Fix contractions with spaces: "I 'm" -> "I'm", "I 'll" -> "I'll"
-    text = re.sub(r"(\w)\s+'(\w)", r"\1'\2", text)
+    text = _CONTRACTION_RE.sub(r"\1'\2", text)
     
     # Fix spaces around hyphens
-    text = re.sub(r'\s*-\s*', '-', text)
+    text = _HYPHEN_RE.sub('-', text)
     
     # Fix single letter followed by space then word (e.g., "D acia" -> "Dacia")
-    text = re.sub(r'\b([A-Z])\s+([a-z])', r'\1\2', text)
+    text = _SPLIT_CAPITAL_RE.sub(r'\1\2', text)
     
     # Fix common split words with lowercase
-    text = re.sub(r'(\w{2,})\s+([a-z]{2,}(?:tion|ment|ing|ness|able|ible|ure|ous|ive|ect|oot|ose|age|ance|ence))\b', r'\1\2', text)
+    text = _SPLIT_SUFFIX_RE.sub(r'\1\2', text)
     
-    # Fix broken abbreviations
-    abbreviations = {
-        r'O\s*B\s*D': 'OBD', r'A\s*B\s*S': 'ABS', r'E\s*S\s*P': 'ESP',
-        r'E\s*C\s*U': 'ECU', r'D\s*T\s*C': 'DTC'
-    }
-    for pattern, replacement in abbreviations.items():
-        text = re.sub(pattern, replacement, text)
+    # Fix broken abbreviations (OBD, ABS, ESP, ECU, DTC) in one pass
+    text = _SPLIT_ABBREV_RE.sub(lambda m: "".join(m.group().split()), text)
     
     # Fix multiple spaces
-    text = re.sub(r'  +', ' ', text)
+    text = _MULTI_SPACE_RE.sub(' ', text)
     
     # Fix space before punctuation
-    text = re.sub(r'\s+([.,!?;:])', r'\1', text)
+    text = _SPACE_BEFORE_PUNCT_RE.sub(r'\1', text)
     
     return text
-
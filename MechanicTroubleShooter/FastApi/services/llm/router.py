@@ -18,22 +18,35 @@ class QueryRoute:
     OUT_OF_SCOPE = RouteDecision.OUT_OF_SCOPE.value
 
 
-def route_query(query: str, history: list = None) -> dict:
-    history_context = _format_history(history) if history else ""
-
-    prompt = f"""You are a routing agent for a Dacia vehicle workshop assistant.
-{history_context}
-USER QUERY: "{query}"
+_ROUTER_PROMPT = """You are a routing agent for a Dacia vehicle workshop assistant.
 
 Choose ONE option:
 1. RAG_NEEDED - Needs workshop manual lookup (repairs, specs, troubleshooting)
 2. DIRECT_ANSWER - General automotive knowledge (basic concepts)
 3. CLARIFICATION_NEEDED - Too vague ("fix it", "help", single words)
 4. OUT_OF_SCOPE - Unrelated to vehicles (weather, recipes, etc.)
+{}
+USER QUERY: "{}"
 
 Respond with JSON only:
 {{"decision": "RAG_NEEDED|DIRECT_ANSWER|CLARIFICATION_NEEDED|OUT_OF_SCOPE", "reasoning": "brief", "reformulated_query": "clearer version"}}"""
 
+_DIRECT_ANSWER_PROMPT = """You are a Dacia vehicle assistant. Answer using general automotive knowledge.
+{}
+Question: {}
+
+Keep it concise. If unsure about Dacia specifics, recommend checking the manual."""
+
+_CLARIFICATION_PROMPT = """The user asked: "{}"
+
+This is too vague. Ask for specifics in 1-2 sentences (vehicle model, symptom, goal)."""
+
+
+def route_query(query: str, history: list = None) -> dict:
+    history_context = _format_history(history) if history else ""
+
+    prompt = _ROUTER_PROMPT.format(history_context, query)
+
     try:
         response = _parse_json_response(call_ollama(prompt))
         
@@ -55,19 +68,13 @@ Respond with JSON only:
 def generate_direct_answer(query: str, history: list = None) -> str:
     history_text = _format_history(history) if history else ""
 
-    prompt = f"""You are a Dacia vehicle assistant. Answer using general automotive knowledge.
-{history_text}
-Question: {query}
-
-Keep it concise. If unsure about Dacia specifics, recommend checking the manual."""
+    prompt = _DIRECT_ANSWER_PROMPT.format(history_text, query)
 
     return call_ollama(prompt)
 
 
 def generate_clarification_request(query: str) -> str:
-    prompt = f"""The user asked: "{query}"
-
-This is too vague. Ask for specifics in 1-2 sentences (vehicle model, symptom, goal)."""
+    prompt = _CLARIFICATION_PROMPT.format(query)
 
     return call_ollama(prompt)
 
@@ -0,0 +1,118 @@
+
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+from typing import Any, Dict, Hashable, Optional
+from langchain_core.documents import Document
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError:
+    # The docstore already reports the missing package at startup
+    orjson = None
+
+
+class PersistentAnswerCache:
+    """
+    Answers stored in SQLite by exact (normalized) question, so they survive restarts.
+
+    Rows are keyed by the docstore's corpus version: after an ingest or reset the
+    old rows no longer match, and they are purged the first time a newer version is seen.
+    Answers computed against an older version than that are not stored.
+    Only the encoded payload is kept, so every hit is decoded into objects the caller owns.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._version: Optional[int] = None
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            "q_hash TEXT NOT NULL, corpus_ver INTEGER NOT NULL, payload BLOB NOT NULL, ts INTEGER NOT NULL, "
+            "PRIMARY KEY (q_hash, corpus_ver))"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def question_hash(question: str, params: Hashable = None) -> str:
+        key = f"{' '.join(question.lower().split())}\x00{params!r}"
+        return hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+
+    def get(self, q_hash: str, corpus_version: int) -> Optional[Dict[str, Any]]:
+        try:
+            with self._lock:
+                self._purge_older(corpus_version)
+                row = self._conn.execute(
+                    "SELECT payload FROM answers WHERE q_hash = ? AND corpus_ver = ?",
+                    (q_hash, corpus_version)
+                ).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                self.hits += 1
+            return self._decode(row[0])
+        except Exception as e:
+            logger.warning("[AnswerCache] Lookup failed: %s", e)
+            return None
+
+    def put(self, q_hash: str, corpus_version: int, result: Dict[str, Any]):
+        try:
+            payload = self._encode(result)
+            with self._lock:
+                self._purge_older(corpus_version)
+                if corpus_version < self._version:
+                    # The query started before an ingest finished: its answer is already stale
+                    return
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?)",
+                    (q_hash, corpus_version, payload, int(time.time()))
+                )
+                self._conn.commit()
+        except Exception as e:
+            logger.warning("[AnswerCache] Failed to save answer: %s", e)
+
+    def get_stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0
+        }
+
+    def _purge_older(self, corpus_version: int):
+        # Caller holds _lock; runs once per new version, not per query. Versions only grow,
+        # so a late call with an older one must not delete the newer rows
+        if self._version is not None and corpus_version <= self._version:
+            return
+        self._conn.execute("DELETE FROM answers WHERE corpus_ver < ?", (corpus_version,))
+        self._conn.commit()
+        self._version = corpus_version
+
+    @staticmethod
+    def _encode(result: Dict[str, Any]) -> bytes:
+        data = dict(result)
+        data["sources"] = [{"page_content": d.page_content, "metadata": d.metadata}
+                           for d in result.get("sources", [])]
+        if orjson is not None:
+            return orjson.dumps(data)
+        return json.dumps(data, ensure_ascii=False).encode("utf-8")
+
+    @staticmethod
+    def _decode(payload: bytes) -> Dict[str, Any]:
+        # Fresh dicts and Documents on every call; never hand out a shared in-memory result
+        data = orjson.loads(payload) if orjson is not None else json.loads(payload)
+        data["sources"] = [Document(page_content=s["page_content"], metadata=dict(s["metadata"]))
+                           for s in data.get("sources", [])]
+        return data
@@ -1,6 +1,7 @@
 
 
 import os
+import re
 import json
 import pickle
 from typing import List, Dict, Any, Optional, Tuple
@@ -12,10 +13,11 @@ _bm25_doc_map: Dict[int, Document] = {}
 
 BM25_PERSIST_PATH = "./chroma_db/bm25_index.pkl"
 
+_NON_TOKEN_RE = re.compile(r'[^\w\s\-\.]')
+
 
 def _tokenize(text: str) -> List[str]:
-    import re
-    text = re.sub(r'[^\w\s\-\.]', ' ', text.lower())
+    text = _NON_TOKEN_RE.sub(' ', text.lower())
     return text.split()
 
 
@@ -188,12 +190,22 @@ def hybrid_search(query: str, k: int = 20, include_images: bool = False) -> List
     
     Stage 1 of 3-Stage Retrieval Pipeline.
     """
-    from services.storage.vector import vector_db
+    from services.storage.vector import vector_db, embed_query
     
     print(f"[Hybrid] Starting hybrid search for: {query[:50]}...")
     
     try:
-        vector_results = vector_db.similarity_search(query, k=k*2, filter={"type": "child"})
+        # Native query: LangChain's wrapper would also fetch distances and rebuild each hit
+        res = vector_db._collection.query(
+            query_embeddings=[list(embed_query(query))],
+            n_results=k*2,
+            where={"type": "child"},
+            include=["documents", "metadatas"]
+        )
+        vector_results = [
+            Document(page_content=content, metadata=meta)
+            for content, meta in zip(res["documents"][0], res["metadatas"][0])
+        ]
         print(f"[Hybrid] Vector search (children): {len(vector_results)} results")
     except Exception as e:
         print(f"[Hybrid] Vector search failed: {e}")
@@ -233,22 +245,21 @@ def hybrid_search(query: str, k: int = 20, include_images: bool = False) -> List
         page_matched_images = []
         if relevant_pages:
             try:
-                all_images = vector_db.get(
-                    where={"type": "image"},
-                    limit=500
+                # Page and file are matched by Chroma in one filtered read, not in Python over every image
+                matched = vector_db.get(
+                    where={"$and": [
+                        {"type": "image"},
+                        {"source_file": {"$in": sorted(relevant_files)}},
+                        {"page": {"$in": sorted(relevant_pages)}}
+                    ]},
+                    include=["documents", "metadatas"]
                 )
                 
-                if all_images and all_images.get('metadatas'):
-                    for i, meta in enumerate(all_images['metadatas']):
-                        img_page = meta.get('page')  
-                        img_source = meta.get('source_file')
-                        if img_page in relevant_pages and img_source in relevant_files:
-                            from langchain_core.documents import Document as LangDoc
-                            doc = LangDoc(
-                                page_content=all_images['documents'][i],
-                                metadata=meta
-                            )
-                            page_matched_images.append(doc)
+                if matched and matched.get('metadatas'):
+                    page_matched_images = [
+                        Document(page_content=content, metadata=meta)
+                        for content, meta in zip(matched['documents'], matched['metadatas'])
+                    ]
                 
                 print(f"[Hybrid] Found {len(page_matched_images)} images from relevant pages")
                     
@@ -0,0 +1,116 @@
+
+import re
+import time
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+from langchain_core.documents import Document
+
+# Fault codes, part numbers, years: any token with a digit. Embeddings barely separate
+# "P0401" from "P0402", so a hit also needs the same set of these
+_CODE_RE = re.compile(r"\b\w*\d(?:[\w\-./]*\w)?")
+
+
+class SemanticQueryCache:
+    """
+    LRU cache of answered queries, looked up by embedding similarity.
+
+    Embeddings are L2-normalized, so one matrix-vector product gives the
+    cosine similarity of the incoming query against every cached query.
+    A match must also mention exactly the same codes and numbers as the query.
+    """
+
+    def __init__(self, max_size: int = 256, ttl_seconds: float = 3600, threshold: float = 0.95):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        self._lock = threading.RLock()
+        # key -> (created_at, params, codes, result); row order of _matrix follows _keys
+        self._entries: "OrderedDict[int, Tuple[float, Hashable, frozenset, Dict[str, Any]]]" = OrderedDict()
+        self._keys: list = []
+        self._matrix: Optional[np.ndarray] = None
+        self._next_key = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, embedding: np.ndarray, params: Hashable = None, query: str = "") -> Optional[Dict[str, Any]]:
+        codes = query_codes(query)
+        with self._lock:
+            if self._matrix is None or not self._keys:
+                self.misses += 1
+                return None
+
+            scores = self._matrix @ embedding
+            now = time.monotonic()
+            # Best match first; a stale, differently-parameterised or other-code entry falls through
+            for row in np.argsort(-scores):
+                if scores[row] < self.threshold:
+                    break
+                key = self._keys[row]
+                created_at, entry_params, entry_codes, result = self._entries[key]
+                if now - created_at > self.ttl_seconds or entry_params != params or entry_codes != codes:
+                    continue
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return _copy_result(result)
+
+            self.misses += 1
+            return None
+
+    def put(self, embedding: np.ndarray, result: Dict[str, Any], params: Hashable = None, query: str = ""):
+        with self._lock:
+            self._evict_expired()
+            while len(self._entries) >= self.max_size:
+                oldest, _ = self._entries.popitem(last=False)
+                self._remove_row(oldest)
+
+            key = self._next_key
+            self._next_key += 1
+            self._entries[key] = (time.monotonic(), params, query_codes(query), _copy_result(result))
+            self._keys.append(key)
+            row = np.asarray(embedding, dtype=np.float32)[None, :]
+            self._matrix = row if self._matrix is None else np.vstack((self._matrix, row))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys = []
+            self._matrix = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0
+            }
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        expired = [k for k, (created_at, _, _, _) in self._entries.items()
+                   if now - created_at > self.ttl_seconds]
+        for key in expired:
+            del self._entries[key]
+            self._remove_row(key)
+
+    def _remove_row(self, key: int):
+        row = self._keys.index(key)
+        del self._keys[row]
+        self._matrix = np.delete(self._matrix, row, axis=0) if self._keys else None
+
+
+def query_codes(text: str) -> frozenset:
+    return frozenset(code.lower() for code in _CODE_RE.findall(text))
+
+
+def _copy_result(result: Dict[str, Any]) -> Dict[str, Any]:
+    # Callers get their own sources and metadata, so nothing they change leaks into the cache
+    copy = dict(result)
+    copy["sources"] = [Document(page_content=d.page_content, metadata=dict(d.metadata))
+                       for d in result.get("sources", [])]
+    if "formatted_sources" in result:
+        copy["formatted_sources"] = [dict(s) for s in result["formatted_sources"]]
+    return copy
@@ -6,15 +6,67 @@ Stage 2: Parent-Child Context Retrieval
 Stage 3: Cross-Encoder Reranking
 """
 
-from typing import List, Dict, Any, Set, Optional
+import os
+import re
+import logging
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Set, Optional, Tuple
 from langchain_core.documents import Document
 
-from services.storage.vector import vector_db
+from core.config import QUERY_CACHE_SIZE, QUERY_CACHE_TTL, QUERY_CACHE_THRESHOLD, ANSWER_CACHE_ENABLED
+from services.storage.vector import vector_db, embed_query
+from services.retrieval.query_cache import SemanticQueryCache
+from services.retrieval.answer_cache import PersistentAnswerCache
 from services.retrieval.reranker import rerank_results
 from services.retrieval.hybrid_search import hybrid_search
-from services.llm.client import generate_chat_answer
+from services.llm.client import generate_chat_answer, warmup_chat_model
 from services.storage.document import get_docstore
 
+logger = logging.getLogger(__name__)
+
+try:
+    from rapidfuzz import fuzz, process as rapidfuzz_process, utils as fuzz_utils
+except ImportError:
+    rapidfuzz_process = None
+    logger.info("[RAG] rapidfuzz not installed, near-duplicate check runs in Python. Run: pip install rapidfuzz")
+
+# Words asking to see something; plurals and "showing"/"located" count too
+_VISUAL_RE = re.compile(
+    r"\b(?:show\w*|diagrams?|pictures?|images?|photos?|where is|locat\w*|look like|see)\b",
+    re.IGNORECASE
+)
+
+# token_set_ratio at or above this marks two chunks as near-duplicates
+NEAR_DUPLICATE_SCORE = 85
+
+# Stored embeddings at least this close mark two chunks as the same passage reworded
+SEMANTIC_DUPLICATE_COSINE = 0.95
+
+# Runs the LLM warmup alongside reranking; nothing waits on it
+_WARMUP_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llm-warmup")
+
+# At most this many candidates per final result reach the cross-encoder;
+# the rest are dropped by a cosine pre-filter on their stored embeddings
+CASCADE_KEEP_FACTOR = 2
+
+# num_ctx is 4096 tokens (~4 chars each); leave room for the prompt rules and history
+MAX_CONTEXT_CHARS = 12000
+
+
+def _vector_ids(docs: List[Document]) -> List[Optional[str]]:
+    # Chroma ids as written at ingest: chunk_id for text children, parent_id for image captions
+    return [doc.metadata.get("chunk_id") or doc.metadata.get("parent_id") for doc in docs]
+
+
+def _similarity_matrix(contents: List[str]) -> Optional[np.ndarray]:
+    """All-pairs token-set similarity (0-100) in native code, or None without rapidfuzz."""
+    if rapidfuzz_process is None:
+        return None
+    return rapidfuzz_process.cdist(contents, contents, scorer=fuzz.token_set_ratio,
+                                   processor=fuzz_utils.default_process,
+                                   score_cutoff=NEAR_DUPLICATE_SCORE, workers=-1)
+
 
 class ParentChildRAG:
     """
@@ -33,9 +85,18 @@ class ParentChildRAG:
         self.persist_dir = persist_dir
         self.vectorstore = vector_db
         self.docstore = get_docstore()
+        # Reset by the API after every ingest (reset_caches), so it never outlives the index
+        self.query_cache = SemanticQueryCache(
+            max_size=QUERY_CACHE_SIZE,
+            ttl_seconds=QUERY_CACHE_TTL,
+            threshold=QUERY_CACHE_THRESHOLD
+        )
+        # Survives restarts instead; keyed by the docstore's corpus version, so it needs no reset
+        self.answer_cache = (PersistentAnswerCache(os.path.join(persist_dir, "answers.sqlite3"))
+                             if ANSWER_CACHE_ENABLED else None)
         
-        count = self.vectorstore._collection.count()
-        print(f"[RAG] 3-Stage Pipeline Initialized. Children: {count}. Parents: {len(self.docstore)}")
+        # Children count is left to /stats: counting the collection here would run on every rebuild
+        logger.info("[RAG] 3-Stage Pipeline Initialized. Parents: %d", len(self.docstore))
     
     def query(self, user_question: str, k: int = 10, child_k: int = 50, 
               use_parent_context: bool = True) -> Dict[str, Any]:
@@ -48,8 +109,26 @@ class ParentChildRAG:
             child_k: Number of candidates for reranking
             use_parent_context: Whether to fetch parent context (Stage 2)
         """
-        print(f"\n[QUERY] {user_question}")
-        print("[RAG] Stage 1: Hybrid Search (Vector + BM25)")
+        logger.debug("[QUERY] %s", user_question)
+        
+        cache_params = (k, child_k, use_parent_context)
+        if self.answer_cache is not None:
+            # Exact repeats, even from before a restart, skip embedding too
+            q_hash = self.answer_cache.question_hash(user_question, cache_params)
+            corpus_version = self.docstore.corpus_version
+            cached = self.answer_cache.get(q_hash, corpus_version)
+            if cached is not None:
+                logger.debug("[RAG] Answer cache hit, skipping retrieval and generation")
+                return cached
+        
+        query_embedding = self._embed_query(user_question)
+        if query_embedding is not None:
+            cached = self.query_cache.get(query_embedding, cache_params, user_question)
+            if cached is not None:
+                logger.debug("[RAG] Semantic cache hit, skipping retrieval and generation")
+                return cached
+        
+        logger.debug("[RAG] Stage 1: Hybrid Search (Vector + BM25)")
         
         is_visual = self._is_visual_query(user_question)
         
@@ -63,119 +142,243 @@ class ParentChildRAG:
         if not child_docs:
             return self._no_results_response()
             
-        print(f"[RAG] Hybrid search returned {len(child_docs)} children")
+        logger.debug("[RAG] Hybrid search returned %d children", len(child_docs))
+        
+        # One Chroma read per query: the children's stored vectors serve both dedup and the cascade
+        stored = self._load_stored_embeddings(child_docs)
         
         # Deduplicate
-        unique_docs = self._deduplicate_aggressively(child_docs)
-        print(f"[RAG] After deduplication: {len(unique_docs)} unique children")
+        rows = self._unique_rows(child_docs, stored)
+        logger.debug("[RAG] After deduplication: %d unique children", len(rows))
+        
+        rows = rows[:child_k]
+        candidates = [child_docs[i] for i in rows]
+        if query_embedding is not None and stored is not None and len(candidates) > CASCADE_KEEP_FACTOR * k:
+            embeddings, found = stored
+            candidates = self._cascade_filter(query_embedding, candidates, CASCADE_KEEP_FACTOR * k,
+                                              embeddings[rows], found[rows])
         
-        candidates = unique_docs[:child_k]
+        # The LLM prefills its static prompt on its own thread while the cross-encoder runs
+        # (fire-and-forget: a no-op when the model is warm or a warmup is already running)
+        _WARMUP_POOL.submit(warmup_chat_model)
         
         # Stage 3: Reranking (before parent retrieval for efficiency)
-        print(f"[RAG] Stage 3: Reranking {len(candidates)} candidates")
-        try:
-            reranked = rerank_results(user_question, candidates, top_k=k)
-        except Exception as e:
-            print(f"[WARN] Rerank failed: {e}")
-            reranked = candidates[:k]
+        if len(candidates) <= k:
+            # Every candidate is kept anyway; the hybrid (RRF) order stands
+            logger.debug("[RAG] Stage 3: Skipped, only %d candidates for k=%d", len(candidates), k)
+            reranked = candidates
+        else:
+            logger.debug("[RAG] Stage 3: Reranking %d candidates", len(candidates))
+            try:
+                reranked = rerank_results(user_question, candidates, top_k=k)
+            except Exception as e:
+                logger.warning("[RAG] Rerank failed: %s", e)
+                reranked = candidates[:k]
         
-        print(f"[RAG] Top {len(reranked)} results after reranking")
+        logger.debug("[RAG] Top %d results after reranking", len(reranked))
         
         # Stage 2: Parent Context Retrieval
         if use_parent_context:
-            print("[RAG] Stage 2: Retrieving parent context")
+            logger.debug("[RAG] Stage 2: Retrieving parent context")
             context = self._build_context_with_parents(reranked)
+            formatted_sources = self._format_sources(reranked)
         else:
-            context = self._build_context(reranked)
+            context, formatted_sources = self._build_context_and_sources(reranked)
         
         # Generate answer
         answer = generate_chat_answer(context, user_question, {"strategy": "3_stage_rag"})
         
-        print(f"[RAG] Answer generated ({len(answer)} chars)")
+        logger.debug("[RAG] Answer generated (%d chars)", len(answer))
         
-        return {
+        result = {
             "answer": answer,
             "sources": reranked,
             "num_sources": len(reranked),
             "context_chars": len(context),
-            "formatted_sources": self._format_sources(reranked),
+            "formatted_sources": formatted_sources,
             "pipeline": "3-stage (hybrid + parent + rerank)"
         }
+        if query_embedding is not None:
+            self.query_cache.put(query_embedding, result, cache_params, user_question)
+        if self.answer_cache is not None:
+            self.answer_cache.put(q_hash, corpus_version, result)
+        
+        return result
     
-    def _build_context_with_parents(self, child_docs: List[Document]) -> str:
+    def _cascade_filter(self, query_embedding: np.ndarray, docs: List[Document], keep: int,
+                        embeddings: np.ndarray, found: np.ndarray) -> List[Document]:
+        """
+        Cheap first rerank stage: keep the `keep` docs closest to the query by
+        bi-encoder cosine, in their hybrid order, so the cross-encoder scores fewer pairs.
+        `embeddings` and `found` are the docs' rows from _stored_embeddings.
+        """
+        # Docs without a stored vector are never dropped by this stage
+        sims = np.full(len(docs), np.inf, dtype=np.float32)
+        sims[found] = embeddings[found] @ query_embedding
+        
+        top = np.sort(np.argpartition(-sims, keep - 1)[:keep])
+        logger.debug("[RAG] Cascade: %d -> %d candidates by embedding similarity", len(docs), len(top))
+        return [docs[i] for i in top]
+    
+    def _load_stored_embeddings(self, docs: List[Document]) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        try:
+            return self._stored_embeddings(docs)
+        except Exception as e:
+            logger.warning("[RAG] Stored embeddings unavailable, semantic dedup and cascade skipped: %s", e)
+            return None
+    
+    def _stored_embeddings(self, docs: List[Document]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The docs' stored vectors as unit rows of a (len(docs), dim) float32 matrix, plus a
+        mask of the docs that have one (the others are zero rows). Only these ids are read
+        from Chroma, so memory is bounded by the candidate count, not the corpus.
+        """
+        ids = _vector_ids(docs)
+        wanted = list({doc_id for doc_id in ids if doc_id})
+        vector_of = {}
+        # An empty id list would make Chroma return the whole collection
+        if wanted:
+            stored = self.vectorstore._collection.get(ids=wanted, include=["embeddings"])
+            vector_of = dict(zip(stored["ids"], stored["embeddings"]))
+        
+        found = np.array([doc_id in vector_of for doc_id in ids], dtype=bool)
+        dim = len(next(iter(vector_of.values()))) if vector_of else 0
+        embeddings = np.zeros((len(docs), dim), dtype=np.float32)
+        if vector_of:
+            embeddings[found] = [vector_of[doc_id] for doc_id, ok in zip(ids, found) if ok]
+            # Unit rows, so every cosine is a bare dot product (older ingests stored unnormalized vectors)
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True) + 1e-12
+        return embeddings, found
+    
+    def reset_caches(self):
+        """Drop cached answers; call after the index changes."""
+        self.query_cache.clear()
+    
+    def _embed_query(self, text: str) -> Optional[np.ndarray]:
+        try:
+            # Same memoized embedding hybrid_search uses, so the cache lookup costs no extra forward pass
+            embedding = np.asarray(embed_query(text), dtype=np.float32)
+            return embedding / (np.linalg.norm(embedding) + 1e-12)
+        except Exception as e:
+            logger.warning("[RAG] Query embedding for cache failed: %s", e)
+            return None
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "query_cache": self.query_cache.get_stats(),
+            "answer_cache": self.answer_cache.get_stats() if self.answer_cache is not None else None
+        }
+    
+    def _build_context_with_parents(self, child_docs: List[Document],
+                                    max_chars: int = MAX_CONTEXT_CHARS) -> str:
         """
         Build context by fetching parent documents for complete sections.
         
         When a child chunk like "Tighten to 20Nm" is found, this retrieves
         the full parent section to ensure no safety steps are missed.
+        Stops adding sources once max_chars is reached, truncating the last one.
         """
         seen_parents: Set[str] = set()
         context_parts = []
+        total = 0
+        
+        # All parents in one lookup; misses fall back to the child text and are logged once
+        # (image captions carry a parent_id too but never have a parent section)
+        parent_ids = {child.metadata.get("parent_id") for child in child_docs
+                      if child.metadata.get("type") != "image"} - {None, ""}
+        parents = self.docstore.mget(list(parent_ids))
+        missing = parent_ids - parents.keys()
+        if missing:
+            logger.warning("[RAG] %d parent sections not in docstore, using child chunks", len(missing))
         
         for i, child in enumerate(child_docs):
             parent_id = child.metadata.get("parent_id")
             section_title = child.metadata.get("section_title", "Unknown")
             
             if parent_id and parent_id not in seen_parents:
-                parent_doc = self.docstore.get_document(parent_id)
+                parent_doc = parents.get(parent_id)
                 
                 if parent_doc:
                     seen_parents.add(parent_id)
                     src = f"[Source {i+1}: {section_title} (Full Section)]"
-                    context_parts.append(f"{src}\n{parent_doc.page_content}")
-                    print(f"    [Parent] Retrieved: {section_title} ({len(parent_doc.page_content)} chars)")
+                    content = parent_doc.page_content
+                    logger.debug("[Parent] Retrieved: %s (%d chars)", section_title, len(content))
                 else:
                     src = f"[Source {i+1}: {section_title}]"
-                    context_parts.append(f"{src}\n{child.page_content}")
+                    content = child.page_content
             elif parent_id in seen_parents:
                 continue
             else:
                 src = f"[Source {i+1}: {section_title}]"
-                context_parts.append(f"{src}\n{child.page_content}")
+                content = child.page_content
+            
+            remaining = max_chars - total - len(src) - 1
+            if remaining <= 0:
+                break
+            context_parts.append(f"{src}\n{content[:remaining]}")
+            total += len(context_parts[-1]) + 2
+            if total >= max_chars:
+                break
         
         context = "\n\n".join(context_parts)
-        print(f"[RAG] Built context: {len(context)} chars from {len(seen_parents)} parent sections")
+        logger.debug("[RAG] Built context: %d chars from %d parent sections", len(context), len(seen_parents))
         return context
     
     def _deduplicate_aggressively(self, docs: List[Document]) -> List[Document]:
+        return [docs[row] for row in self._unique_rows(docs)]
+    
+    def _unique_rows(self, docs: List[Document],
+                     stored: Optional[Tuple[np.ndarray, np.ndarray]] = None) -> List[int]:
+        """Rows of the docs kept by dedup, in order; `stored` is reused if already fetched."""
         if not docs:
             return []
         
-        unique_docs = []
-        seen_content: Set[str] = set()
+        kept_rows: List[int] = []
+        # Fallback only: word sets of the kept docs, split once instead of once per pair
+        kept_words: List[Set[str]] = []
         seen_normalized: Set[str] = set()  
+        contents = [doc.page_content.strip() for doc in docs]
+        similarity = _similarity_matrix(contents)
+        if stored is None:
+            stored = self._load_stored_embeddings(docs)
+        # Pairwise cosine of the stored vectors; rows of docs without one are zero
+        semantic = stored[0] @ stored[0].T if stored is not None else None
         
-        for doc in docs:
-            content = doc.page_content.strip()
-            
-            normalized = ' '.join(content.lower().split())
-            
-            if content in seen_content:
-                continue
+        for row, content in enumerate(contents):
+            tokens = content.lower().split()
+            normalized = ' '.join(tokens)
             
+            # Also catches exact duplicates
             if normalized in seen_normalized:
                 continue
             
-            is_similar = False
-            for existing_doc in unique_docs:
-                if self._is_too_similar(content, existing_doc.page_content):
-                    is_similar = True
-                    break
+            if similarity is not None:
+                is_similar = bool(kept_rows) and similarity[row, kept_rows].max() >= NEAR_DUPLICATE_SCORE
+            else:
+                words = set(tokens)
+                is_similar = any(self._is_too_similar(content, contents[kept], words1=words, words2=kept_set)
+                                 for kept, kept_set in zip(kept_rows, kept_words))
+            
+            # Paraphrases with little word overlap still sit close together in embedding space
+            if not is_similar and semantic is not None and kept_rows:
+                is_similar = semantic[row, kept_rows].max() >= SEMANTIC_DUPLICATE_COSINE
             
             if is_similar:
                 continue
                         
-            seen_content.add(content)
             seen_normalized.add(normalized)
-            unique_docs.append(doc)
+            kept_rows.append(row)
+            if similarity is None:
+                kept_words.append(words)
         
-        removed = len(docs) - len(unique_docs)
+        removed = len(docs) - len(kept_rows)
         if removed > 0:
-            print(f"[DEDUP] Removed {removed} duplicate/similar chunks")
+            logger.debug("[DEDUP] Removed %d duplicate/similar chunks", removed)
         
-        return unique_docs
+        return kept_rows
     
-    def _is_too_similar(self, content1: str, content2: str, threshold: float = 0.85) -> bool:
+    def _is_too_similar(self, content1: str, content2: str, threshold: float = 0.85,
+                        words1: Optional[Set[str]] = None, words2: Optional[Set[str]] = None) -> bool:
         if content1 == content2:
             return True
         
@@ -184,8 +387,10 @@ class ParentChildRAG:
             shorter = content2 if len(content1) > len(content2) else content1
             return shorter in longer
         
-        words1 = set(content1.lower().split())
-        words2 = set(content2.lower().split())
+        if words1 is None:
+            words1 = set(content1.lower().split())
+        if words2 is None:
+            words2 = set(content2.lower().split())
         
         if not words1 or not words2:
             return False
@@ -197,15 +402,24 @@ class ParentChildRAG:
         return similarity >= threshold
     
     def _is_visual_query(self, query: str) -> bool:
-        keywords = ["show", "diagram", "picture", "image", "photo", "location", "look like", "see"]
-        return any(k in query.lower() for k in keywords)
+        return _VISUAL_RE.search(query) is not None
 
-    def _build_context(self, docs: List[Document]) -> str:
+    def _build_context_and_sources(self, docs: List[Document]) -> Tuple[str, List[Dict[str, Any]]]:
+        # One pass over the docs for both the prompt context and the source list
         parts = []
+        sources = []
         for i, doc in enumerate(docs):
-            src = f"[Source {i+1}, {doc.metadata.get('section_title', 'Unknown')}]"
-            parts.append(f"{src}\n{doc.page_content}")
-        return "\n\n".join(parts)
+            meta = doc.metadata
+            title = meta.get("section_title")
+            content = doc.page_content
+            parts.append(f"[Source {i+1}, {title or 'Unknown'}]\n{content}")
+            sources.append({
+                "source_num": i+1,
+                "title": title,
+                "file": meta.get("source_file"),
+                "preview": content[:200]
+            })
+        return "\n\n".join(parts), sources
     
     def _format_sources(self, docs: List[Document]) -> List[Dict[str, Any]]:
         return [{
@@ -1,32 +1,227 @@
 
+import os
+import json
 import time
-from typing import List, Tuple
+import queue
+import logging
+import logging.handlers
+import threading
+import numpy as np
+from concurrent.futures import Future
+from typing import List, Optional, Tuple
 from langchain_core.documents import Document
+from core.config import (RERANKER_ONNX_DIR, RERANKER_ONNX_FILE, RERANKER_MODEL,
+                         RERANK_LOG_ENABLED, RERANK_LOG_PATH, RERANK_LOG_MAX_BYTES)
+
+logger = logging.getLogger(__name__)
 
 _reranker = None
-_model_name = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+_reranker_lock = threading.Lock()
+_model_name = RERANKER_MODEL
+
+# Candidates scored per forward pass: one pass covers a normal candidate list
+RERANK_BATCH_SIZE = 64
+# Token limit for (query, passage) pairs; the tokenizer truncates the passage past it
+MAX_SEQ_TOKENS = 512
+# Rerank requests arriving within this many seconds share one predict(), up to this many pairs
+BATCH_WINDOW = 0.008
+MAX_BATCH_PAIRS = 128
 
 
 def get_reranker():
     
     global _reranker
     
-    if _reranker is None:
-        print(f"🔄 [Reranker] Loading cross-encoder model: {_model_name}...")
-        start = time.time()
+    if _reranker is not None:
+        return _reranker
+    
+    # The import-time prewarm thread and the first query may both get here
+    with _reranker_lock:
+        if _reranker is None:
+            logger.info("[Reranker] Loading cross-encoder model: %s...", _model_name)
+            start = time.time()
+            
+            try:
+                from sentence_transformers import CrossEncoder
+                import torch
+                if torch.cuda.is_available():
+                    _reranker = CrossEncoder(_model_name, device='cuda', max_length=MAX_SEQ_TOKENS,
+                                             automodel_args={'torch_dtype': torch.float16})
+                else:
+                    _reranker = _load_onnx_reranker() or CrossEncoder(_model_name, max_length=MAX_SEQ_TOKENS)
+                elapsed = round(time.time() - start, 2)
+                logger.info("[Reranker] Model loaded in %ss", elapsed)
+            except ImportError:
+                logger.error("[Reranker] sentence-transformers not installed!")
+                return None
+            except Exception as e:
+                logger.error("[Reranker] Failed to load model: %s", e)
+                return None
+    
+    return _reranker
+
+
+class OnnxCrossEncoder:
+    """
+    CPU stand-in for CrossEncoder.predict, running an INT8-quantized ONNX
+    export of the same model. Scores go through the same sigmoid.
+    """
+    
+    def __init__(self, model_path: str, tokenizer_source: str):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
         
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_source)
+        self._input_names = {i.name for i in self.session.get_inputs()}
+    
+    def predict(self, pairs, batch_size: int = 32, convert_to_numpy: bool = True,
+                show_progress_bar: bool = False) -> np.ndarray:
+        scores = []
+        for i in range(0, len(pairs), batch_size):
+            batch = pairs[i:i + batch_size]
+            encoded = self.tokenizer([q for q, _ in batch], [p for _, p in batch], padding=True,
+                                     truncation=True, max_length=MAX_SEQ_TOKENS, return_tensors="np")
+            feeds = {k: v.astype(np.int64) for k, v in encoded.items() if k in self._input_names}
+            logits = self.session.run(None, feeds)[0]
+            scores.append(1 / (1 + np.exp(-logits[:, 0])))
+        return np.concatenate(scores) if scores else np.empty(0, dtype=np.float32)
+
+
+def _onnx_model_path() -> Tuple[str, str]:
+    """(model file, tokenizer source): a local export if there is one, else the published INT8 file."""
+    local_model = os.path.join(RERANKER_ONNX_DIR, "model.onnx")
+    if os.path.exists(local_model):
+        # Export with: optimum-cli export onnx --model <_model_name> --task text-classification <RERANKER_ONNX_DIR>
+        model_path = os.path.join(RERANKER_ONNX_DIR, "model_int8.onnx")
+        if not os.path.exists(model_path):
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            logger.info("[Reranker] Quantizing ONNX cross-encoder to INT8 (one-time)...")
+            quantize_dynamic(local_model, model_path, weight_type=QuantType.QInt8)
+        return model_path, RERANKER_ONNX_DIR
+    
+    # The model's maintainers publish quantized ONNX files next to the weights
+    from huggingface_hub import hf_hub_download
+    return hf_hub_download(_model_name, RERANKER_ONNX_FILE), _model_name
+
+
+def _load_onnx_reranker() -> Optional[OnnxCrossEncoder]:
+    try:
+        model_path, tokenizer_source = _onnx_model_path()
+        reranker = OnnxCrossEncoder(model_path, tokenizer_source)
+        logger.info("[Reranker] Using INT8 ONNX cross-encoder: %s", model_path)
+        return reranker
+    except ImportError:
+        logger.warning("[Reranker] onnxruntime not installed, using PyTorch on CPU. Run: pip install onnxruntime")
+    except Exception as e:
+        logger.warning("[Reranker] ONNX model failed to load, using PyTorch on CPU: %s", e)
+    return None
+
+
+def _predict(reranker, query: str, documents: List[Document]) -> np.ndarray:
+    # Image captions and overlapping chunks often repeat the same passage:
+    # score each distinct passage once and map the scores back. Keyed on the whole
+    # text, since chunks that only share an opening are different passages
+    row_of = {}
+    mapping = []
+    for doc in documents:
+        mapping.append(row_of.setdefault(doc.page_content, len(row_of)))
+    
+    passages = list(row_of)
+    scores = _batcher.submit(reranker, [[query, passage] for passage in passages]).result()
+    if RERANK_LOG_ENABLED:
+        # Teacher scores for distilling a smaller domain reranker (see RERANKER_MODEL)
+        _rerank_log().info("\n".join(
+            json.dumps({"query": query, "passage": passage, "score": float(score)}, ensure_ascii=False)
+            for passage, score in zip(passages, scores)))
+    return scores[mapping]
+
+
+class _RerankBatcher:
+    """
+    Merges rerank requests from concurrent chats into one predict() call:
+    the first request waits up to BATCH_WINDOW for others, up to MAX_BATCH_PAIRS pairs.
+    """
+    
+    def __init__(self):
+        self._q: "queue.Queue" = queue.Queue()
+        threading.Thread(target=self._loop, daemon=True, name="rerank-batcher").start()
+    
+    def submit(self, reranker, pairs: List[List[str]]) -> Future:
+        future = Future()
+        self._q.put((reranker, pairs, future))
+        return future
+    
+    def _loop(self):
+        while True:
+            batch = [self._q.get()]
+            n_pairs = len(batch[0][1])
+            deadline = time.monotonic() + BATCH_WINDOW
+            while n_pairs < MAX_BATCH_PAIRS:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._q.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                n_pairs += len(batch[-1][1])
+            self._run(batch)
+    
+    def _run(self, batch):
+        pairs = [pair for _, request_pairs, _ in batch for pair in request_pairs]
         try:
-            from sentence_transformers import CrossEncoder
-            _reranker = CrossEncoder(_model_name)
-            elapsed = round(time.time() - start, 2)
-        except ImportError:
-            print(" [Reranker] sentence-transformers not installed!")
-            return None
+            # Similar lengths share a mini-batch, so little of it is padding; scores are put back in place
+            order = np.argsort([len(passage) for _, passage in pairs], kind='stable')
+            sorted_scores = batch[0][0].predict([pairs[i] for i in order], batch_size=RERANK_BATCH_SIZE,
+                                                convert_to_numpy=True, show_progress_bar=False)
+            scores = np.empty(len(pairs), dtype=np.float32)
+            scores[order] = np.asarray(sorted_scores).ravel()
         except Exception as e:
-            print(f"❌ [Reranker] Failed to load model: {e}")
-            return None
-    
-    return _reranker
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        
+        start = 0
+        for _, request_pairs, future in batch:
+            future.set_result(scores[start:start + len(request_pairs)])
+            start += len(request_pairs)
+
+
+_batcher = _RerankBatcher()
+
+
+_score_log: Optional[logging.Logger] = None
+_score_log_lock = threading.Lock()
+
+
+def _rerank_log() -> logging.Logger:
+    # Own logger and rotating file, kept out of the app log: one JSON object per line.
+    # Created on first use, so nothing is opened unless RERANK_LOG_ENABLED is set
+    global _score_log
+    with _score_log_lock:
+        if _score_log is None:
+            log = logging.getLogger("rerank_scores")
+            handler = logging.handlers.RotatingFileHandler(RERANK_LOG_PATH, maxBytes=RERANK_LOG_MAX_BYTES,
+                                                           backupCount=5, encoding="utf-8", delay=True)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            log.addHandler(handler)
+            log.setLevel(logging.INFO)
+            log.propagate = False
+            _score_log = log
+    return _score_log
+
+
+def _top_k_indices(scores, top_k: int) -> np.ndarray:
+    # Partition out the k best in O(n), then sort only those k
+    scores = np.asarray(scores, dtype=np.float32).ravel()
+    k = min(top_k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    top_idx = np.argpartition(-scores, k - 1)[:k]
+    return top_idx[np.argsort(-scores[top_idx], kind='stable')]
 
 
 def rerank_results(query: str, documents: List[Document], top_k: int = 10) -> List[Document]:
@@ -37,40 +232,32 @@ def rerank_results(query: str, documents: List[Document], top_k: int = 10) -> Li
     reranker = get_reranker()
     
     if reranker is None:
-        print("⚠️ [Reranker] Model not available, returning original order")
+        logger.warning("[Reranker] Model not available, returning original order")
         return documents[:top_k]
     
-    print(f" [Reranker] Re-scoring {len(documents)} candidates...")
+    logger.debug("[Reranker] Re-scoring %d candidates...", len(documents))
     start = time.time()
     
     try:
-        pairs = [[query, doc.page_content] for doc in documents]
-        
-        scores = reranker.predict(pairs)
-        
-        scored_docs: List[Tuple[Document, float]] = list(zip(documents, scores))
-        
-        scored_docs.sort(key=lambda x: x[1], reverse=True)
-        
-   
-        actual_k = min(top_k, len(scored_docs))
-        reranked = [doc for doc, score in scored_docs[:actual_k]]
+        scores = _predict(reranker, query, documents)
+        top_idx = _top_k_indices(scores, top_k)
+        reranked = [documents[i] for i in top_idx]
         
         elapsed = round(time.time() - start, 3)
         
-        print(f" [Reranker] Complete in {elapsed}s")
-        print(f"   Top scores: {[round(s, 10) for _, s in scored_docs[:3]]}")
+        logger.debug("[Reranker] Complete in %ss", elapsed)
+        logger.debug("[Reranker] Top scores: %s", scores[top_idx[:3]])
         
         if documents and reranked:
             original_first = documents[0].page_content[:50]
             reranked_first = reranked[0].page_content[:50]
             if original_first != reranked_first:
-                print(f"    Reordering detected - top result changed")
+                logger.debug("[Reranker] Reordering detected - top result changed")
         
         return reranked
         
     except Exception as e:
-        print(f" [Reranker] Scoring failed: {e}")
+        logger.warning("[Reranker] Scoring failed: %s", e)
         return documents[:min(top_k, len(documents))]
     
    
@@ -87,16 +274,12 @@ def rerank_with_scores(query: str, documents: List[Document], top_k: int = 10) -
         return [(doc, 0.0) for doc in documents[:top_k]]
     
     try:
-        pairs = [[query, doc.page_content] for doc in documents]
-        scores = reranker.predict(pairs)
-        
-        scored_docs = list(zip(documents, scores))
-        scored_docs.sort(key=lambda x: x[1], reverse=True)
+        scores = _predict(reranker, query, documents)
         
-        return scored_docs[:top_k]
+        return [(documents[i], float(scores[i])) for i in _top_k_indices(scores, top_k)]
         
     except Exception as e:
-        print(f" [Reranker] Failed: {e}")
+        logger.warning("[Reranker] Failed: %s", e)
         return [(doc, 0.0) for doc in documents[:top_k]]
 
 
@@ -107,7 +290,7 @@ def filter_low_relevance(documents: List[Document], scores: List[float],
     
     if len(filtered) < len(documents):
         removed = len(documents) - len(filtered)
-        print(f"   🗑️ [Reranker] Filtered {removed} low-relevance chunks (threshold: {threshold})")
+        logger.debug("[Reranker] Filtered %d low-relevance chunks (threshold: %s)", removed, threshold)
     
     return filtered
 
@@ -115,4 +298,8 @@ def filter_low_relevance(documents: List[Document], scores: List[float],
 
 
     
-  
\ No newline at end of file
+  
+
+
+# Load the cross-encoder in the background so the first query doesn't wait for it
+threading.Thread(target=get_reranker, daemon=True, name="reranker-prewarm").start()
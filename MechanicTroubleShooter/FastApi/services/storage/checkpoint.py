@@ -0,0 +1,49 @@
+
+import os
+import json
+from threading import Lock
+from typing import Dict, List, Set
+
+
+class IngestCheckpoint:
+
+    def __init__(self, path: str):
+        self.path = path
+        self._steps: Dict[str, List[str]] = {}
+        self._lock = Lock()
+
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self._steps = json.load(f)
+            except Exception as e:
+                print(f"[WARN] Failed to load ingest checkpoint: {e}")
+
+    def has(self, file_hash: str, step: str) -> bool:
+        with self._lock:
+            return step in self._steps.get(file_hash, ())
+
+    def mark(self, file_hash: str, step: str):
+        with self._lock:
+            steps = self._steps.setdefault(file_hash, [])
+            if step not in steps:
+                steps.append(step)
+                self._save()
+
+    def clear(self, file_hash: str):
+        with self._lock:
+            if self._steps.pop(file_hash, None) is not None:
+                self._save()
+
+    def unfinished(self) -> Set[str]:
+        with self._lock:
+            return set(self._steps)
+
+    def _save(self):
+        try:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._steps, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"[WARN] Failed to save ingest checkpoint: {e}")
@@ -1,103 +1,241 @@
 
 import os
+import sys
 import json
-from typing import Dict, List, Optional
+import time
+import queue
+import atexit
+import sqlite3
+import threading
+import functools
+from typing import Dict, List, Optional, Tuple
 from langchain_core.documents import Document
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, SystemMessage
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    print("[INFO] orjson not installed, docstore metadata uses the json module. Run: pip install orjson")
+
+# Writer thread coalesces up to this many pending writes, or this many seconds, per save
+WRITE_BATCH_SIZE = 64
+WRITE_BATCH_WINDOW = 0.1
+
+def _dump_metadata(metadata: Dict) -> str:
+    if orjson is not None:
+        return orjson.dumps(metadata).decode('utf-8')
+    return json.dumps(metadata, ensure_ascii=False)
+
+
+def _load_metadata(text: str) -> Dict:
+    # Runs once per parent at startup, so the parser dominates load time
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+# Metadata strings shorter than this (file hashes, file names, models...) are interned
+INTERN_MAX_LEN = 128
+
 class ParentDocumentStore:
-   
-    
-    _instance: Optional['ParentDocumentStore'] = None
+
+    def __init__(self, persist_dir: str = "./chroma_parent_child"):
+        self.persist_dir = persist_dir
+        self.persist_path = os.path.join(persist_dir, "docstore.sqlite3")
+        # Pre-SQLite store, imported the first time the database is created
+        self.legacy_path = os.path.join(persist_dir, "docstore.json")
+        self.store: Dict[str, Document] = {}
+        # Bumped when the corpus changes (each finished ingest, deletes, clear), persisted,
+        # never reset: keys answer caches
+        self.corpus_version = 0
+        self._lock = threading.Lock()
+        # (op, key): ("put", doc_id), ("delete_hash", file_hash), ("clear", "") or ("version", "")
+        self._write_q: "queue.Queue[Tuple[str, str]]" = queue.Queue()
+
+        os.makedirs(self.persist_dir, exist_ok=True)
+
+        self._conn = self._connect()
+        self._load()
+
+        self._writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self._writer_thread.start()
+        atexit.register(self.flush)
+
+        print(f" [DocStore] Parent document store initialized ({len(self.store)} documents)")
     
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super().__new__(cls)
-            cls._instance._initialized = False
-        return cls._instance
+    def _connect(self) -> sqlite3.Connection:
+        is_new = not os.path.exists(self.persist_path)
+        # Used by __init__, then only by the writer thread
+        conn = sqlite3.connect(self.persist_path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS parents ("
+            "id TEXT PRIMARY KEY, file_hash TEXT, page_content TEXT NOT NULL, metadata TEXT NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS parents_file_hash ON parents (file_hash)")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        if is_new:
+            self._import_legacy(conn)
+        conn.commit()
+        return conn
     
-    def __init__(self, persist_dir: str = "./chroma_parent_child"):
-        if not self._initialized:
-            self.persist_dir = persist_dir
-            self.persist_path = os.path.join(persist_dir, "docstore.json")
-            self.store: Dict[str, Document] = {}
-            
-            os.makedirs(self.persist_dir, exist_ok=True)
-            
-            self._load()
-            
-            self._initialized = True
-            print(f" [DocStore] Parent document store initialized ({len(self.store)} documents)")
+    def _import_legacy(self, conn: sqlite3.Connection):
+        if not os.path.exists(self.legacy_path):
+            return
+        try:
+            with open(self.legacy_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            conn.executemany(
+                "INSERT OR IGNORE INTO parents VALUES (?, ?, ?, ?)",
+                (
+                    (doc_id, doc_data.get('metadata', {}).get('file_hash'),
+                     doc_data.get('page_content', ''), _dump_metadata(doc_data.get('metadata', {})))
+                    for doc_id, doc_data in data.items()
+                )
+            )
+            print(f"    [DocStore] Imported {len(data)} parents from {self.legacy_path}")
+        except Exception as e:
+            print(f"    [DocStore] Could not import legacy docstore: {e}")
     
     def _load(self):
-        if os.path.exists(self.persist_path):
-            try:
-                with open(self.persist_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    for doc_id, doc_data in data.items():
-                        self.store[doc_id] = Document(
-                            page_content=doc_data.get('page_content', ''),
-                            metadata=doc_data.get('metadata', {})
-                        )
+        try:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'corpus_version'").fetchone()
+            # A new database starts from the clock, so a recreated store never reuses an old version
+            self.corpus_version = row[0] if row else int(time.time())
+            for doc_id, page_content, metadata in self._conn.execute(
+                    "SELECT id, page_content, metadata FROM parents"):
+                self.store[doc_id] = Document(
+                    page_content=page_content,
+                    metadata=self._intern_metadata(_load_metadata(metadata))
+                )
+            if self.store:
                 print(f"    [DocStore] Loaded {len(self.store)} parents from {self.persist_path}")
-            except Exception as e:
-                print(f"    [DocStore] Failed to load persistence file: {e}")
+        except Exception as e:
+            print(f"    [DocStore] Failed to load persistence file: {e}")
     
-    def _save(self):
+    def _apply(self, ops: List[Tuple[str, str]]):
+        # Only what changed is written: one row per added parent, one statement per delete
         try:
-            data = {
-                doc_id: {
-                    'page_content': doc.page_content,
-                    'metadata': doc.metadata
-                }
-                for doc_id, doc in self.store.items()
-            }
-            
-            with open(self.persist_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            rows = []
+            with self._conn:
+                for op, key in ops:
+                    if op == "put":
+                        with self._lock:
+                            doc = self.store.get(key)
+                        if doc is not None:
+                            rows.append((key, doc.metadata.get("file_hash"), doc.page_content,
+                                         _dump_metadata(doc.metadata)))
+                        continue
+                    
+                    # Deletes must land after the puts queued before them
+                    if rows:
+                        self._conn.executemany("INSERT OR REPLACE INTO parents VALUES (?, ?, ?, ?)", rows)
+                        rows = []
+                    if op == "delete_hash":
+                        self._conn.execute("DELETE FROM parents WHERE file_hash = ?", (key,))
+                    elif op == "clear":
+                        self._conn.execute("DELETE FROM parents")
+                
+                if rows:
+                    self._conn.executemany("INSERT OR REPLACE INTO parents VALUES (?, ?, ?, ?)", rows)
+                
+                with self._lock:
+                    version = self.corpus_version
+                self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('corpus_version', ?)", (version,))
                 
         except Exception as e:
             print(f"    [DocStore] Failed to save persistence file: {e}")
     
+    def _writer_loop(self):
+        while True:
+            batch = [self._write_q.get()]
+            deadline = time.monotonic() + WRITE_BATCH_WINDOW
+            while len(batch) < WRITE_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._write_q.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            
+            self._apply(batch)
+            for _ in batch:
+                self._write_q.task_done()
+    
+    @staticmethod
+    def _intern_metadata(metadata: Dict) -> Dict:
+        # Parents of one manual repeat the same file_hash/source_file/vehicle_model strings;
+        # interning makes them share a single object instead of one copy per parent
+        for key, value in metadata.items():
+            if isinstance(value, str) and len(value) < INTERN_MAX_LEN:
+                metadata[key] = sys.intern(value)
+        return metadata
+    
+    def flush(self):
+        """Block until every queued write has been persisted."""
+        self._write_q.join()
+    
     def add_document(self, doc_id: str, document: Document):
         
-        self.store[doc_id] = document
-        self._save()
+        self._intern_metadata(document.metadata)
+        with self._lock:
+            self.store[doc_id] = document
+        self._write_q.put(("put", doc_id))
     
     def get_document(self, doc_id: str) -> Optional[Document]:
         
         return self.store.get(doc_id)
     
+    def mget(self, doc_ids: List[str]) -> Dict[str, Document]:
+        """Fetch many parents at once; ids that aren't stored are left out."""
+        store = self.store
+        return {doc_id: store[doc_id] for doc_id in doc_ids if doc_id in store}
+    
     def get_documents(self, doc_ids: List[str]) -> List[Document]:
         
         return [self.store[doc_id] for doc_id in doc_ids if doc_id in self.store]
     
     def delete_by_file_hash(self, file_hash: str) -> int:
         
-        to_delete = [
-            doc_id for doc_id, doc in self.store.items()
-            if doc.metadata.get("file_hash") == file_hash
-        ]
-        
-        for doc_id in to_delete:
-            del self.store[doc_id]
-        
-        if to_delete:
-            self._save()
-        
-        return len(to_delete)
+        deleted = 0
+        with self._lock:
+            for doc_id in list(self.store):
+                if self.store[doc_id].metadata.get("file_hash") == file_hash:
+                    del self.store[doc_id]
+                    deleted += 1
+            if deleted:
+                self.corpus_version += 1
+
+        if deleted:
+            self._write_q.put(("delete_hash", file_hash))
+
+        return deleted
+    
+    def bump_corpus_version(self):
+        """Mark the corpus as changed, e.g. once an ingest's vectors are all written."""
+        with self._lock:
+            self.corpus_version += 1
+        self._write_q.put(("version", ""))
     
     def clear(self):
-        count = len(self.store)
-        self.store.clear()
-        self._save()
+        with self._lock:
+            count = len(self.store)
+            self.store.clear()
+            self.corpus_version += 1
+        self._write_q.put(("clear", ""))
         print(f"  [DocStore] Cleared {count} parent documents")
     
     def get_stats(self) -> Dict[str, int]:
+        # /stats can run while an ingest adds parents: count over a snapshot, not the live dict
+        with self._lock:
+            docs = list(self.store.values())
+        total_chars = sum(len(doc.page_content) for doc in docs)
         return {
-            "total_parents": len(self.store),
-            "total_chars": sum(len(doc.page_content) for doc in self.store.values()),
-            "avg_chars": sum(len(doc.page_content) for doc in self.store.values()) // len(self.store) if self.store else 0,
+            "total_parents": len(docs),
+            "total_chars": total_chars,
+            "avg_chars": total_chars // len(docs) if docs else 0,
             "persist_path": self.persist_path
         }
     
@@ -108,9 +246,11 @@ class ParentDocumentStore:
         return f"<ParentDocumentStore: {len(self.store)} documents (persisted at {self.persist_path})>"
 
 
-_docstore = ParentDocumentStore()
+@functools.cache
+def _make_store(persist_dir: str) -> ParentDocumentStore:
+    return ParentDocumentStore(persist_dir)
 
 
-def get_docstore() -> ParentDocumentStore:
-    
-    return _docstore
\ No newline at end of file
+def get_docstore(persist_dir: str = "./chroma_parent_child") -> ParentDocumentStore:
+    # One store per directory for the whole process
+    return _make_store(persist_dir)
@@ -1,12 +1,29 @@
 import os
-import hashlib
+import queue
+import functools
+import threading
+import chromadb
+from concurrent.futures import Future
+from typing import List, Tuple
 from langchain_chroma import Chroma
 from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_core.documents import Document
+from core.config import VECTOR_ADD_BATCH_SIZE, EMBED_BATCH_SIZE
 
 PERSIST_DIRECTORY = "./chroma_db"
+# Documents per Chroma write: a few embedding batches each, small enough to stay clear of OOM
+ADD_BATCH_SIZE = VECTOR_ADD_BATCH_SIZE
 os.makedirs(PERSIST_DIRECTORY, exist_ok=True)
 
+COLLECTION_NAME = "car_manual_rag"
+# Embeddings are unit-norm, so cosine space matches the reranker/cache similarity exactly;
+# a denser graph and wider search beam trade a little build time for recall at k=100+
+HNSW_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 32,
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 64
+}
+
 def get_device():
     try:
         import torch
@@ -26,122 +43,76 @@ embedding_function = HuggingFaceEmbeddings(
     model_kwargs={'device': DEVICE},
     encode_kwargs={
         'normalize_embeddings': True,
-        'batch_size': 64
+        'batch_size': EMBED_BATCH_SIZE
     }
 )
 
-vector_db = Chroma(
-    persist_directory=PERSIST_DIRECTORY,
-    embedding_function=embedding_function,
-    collection_name="car_manual_rag"
-)
+def _open_collection(fresh: bool = False) -> Chroma:
+    # HNSW settings only take effect when a collection is created; an existing index keeps its own
+    exists = not fresh and COLLECTION_NAME in {c.name for c in _client.list_collections()}
+    return Chroma(
+        client=_client,
+        embedding_function=embedding_function,
+        collection_name=COLLECTION_NAME,
+        collection_metadata=None if exists else HNSW_METADATA
+    )
+
+_client = chromadb.PersistentClient(path=PERSIST_DIRECTORY)
+vector_db = _open_collection()
 
 print(" [Init] ChromaDB Connected.")
 print(f" [Stats] Current collection size: {vector_db._collection.count()} documents\n")
 
 
-def compute_file_hash(file_path: str) -> str:
-    sha256_hash = hashlib.sha256()
-    
-    try:
-        with open(file_path, "rb") as f:
-            for byte_block in iter(lambda: f.read(4096), b""):
-                sha256_hash.update(byte_block)
-        return sha256_hash.hexdigest()
-    except Exception as e:
-        print(f" [Hash] Failed to compute hash: {e}")
-        return None
+# Most queries embedded in one forward pass when chats arrive together
+MAX_QUERY_EMBED_BATCH = 32
 
 
-def is_document_indexed(file_path: str) -> bool:
-    file_hash = compute_file_hash(file_path)
+class _QueryEmbedBatcher:
+    """
+    Embeds queries from concurrent chats together: whatever queued up while the
+    previous forward pass ran goes into the next one, so a lone query never waits.
+    """
     
-    if not file_hash:
-        return False
+    def __init__(self):
+        self._q: "queue.Queue" = queue.Queue()
+        threading.Thread(target=self._loop, daemon=True, name="query-embed-batcher").start()
     
-    try:
-        results = vector_db.get(
-            where={"file_hash": file_hash},
-            limit=1
-        )
-        
-        if results and results['ids']:
-            print(f" [Check] Document already indexed (hash: {file_hash[:16]}...)")
-            return True
-        else:
-            print(f" [Check] Document is new (hash: {file_hash[:16]}...)")
-            return False
-            
-    except Exception as e:
-        print(f" [Check] Could not verify indexing status: {e}")
-        return False
-
-
-def add_multimodal_documents(chunks, file_path=None):
-
-    if not chunks:
-        print(f"    No chunks to add, skipping...")
-        return
-
-    documents = []
-    print(f" [VectorDB] Preparing {len(chunks)} chunks...")
+    def submit(self, query: str) -> Future:
+        future = Future()
+        self._q.put((query, future))
+        return future
     
-    file_hash = None
-    if file_path:
-        file_hash = compute_file_hash(file_path)
-
-    for idx, chunk in enumerate(chunks):
-        try:
-            content = chunk.get("text", "")
-            metadata = chunk.get("metadata", {})
-            
-            if not content or len(content.strip()) < 10:
-                continue
-            
-            if file_hash and "file_hash" not in metadata:
-                metadata["file_hash"] = file_hash
-            
-            if file_path and "source_file" not in metadata:
-                metadata["source_file"] = os.path.basename(file_path)
-            
-            if "chunk_id" not in metadata:
-                metadata["chunk_id"] = f"chunk_{idx}"
-            
-            doc = Document(
-                page_content=content,
-                metadata=metadata
-            )
-            
-            documents.append(doc)
-            
-        except Exception as e:
-            print(f"    Failed to process chunk {idx}: {e}")
-            continue
-
-    BATCH_SIZE = 5000
+    def _loop(self):
+        while True:
+            batch = [self._q.get()]
+            while len(batch) < MAX_QUERY_EMBED_BATCH:
+                try:
+                    batch.append(self._q.get_nowait())
+                except queue.Empty:
+                    break
+            self._run(batch)
     
-    if documents:
+    @staticmethod
+    def _run(batch: List[Tuple[str, Future]]):
         try:
-            total_docs = len(documents)
-            
-            if total_docs <= BATCH_SIZE:
-                vector_db.add_documents(documents)
-                print(f"    Committed {total_docs} vectors to ChromaDB")
-            else:
-                print(f"    Large batch detected ({total_docs} docs), splitting into chunks of {BATCH_SIZE}...")
-                
-                for i in range(0, total_docs, BATCH_SIZE):
-                    batch = documents[i:i + BATCH_SIZE]
-                    vector_db.add_documents(batch)
-                    print(f"       Batch {i // BATCH_SIZE + 1}: Committed {len(batch)} vectors")
-                
-                print(f"    Total committed: {total_docs} vectors to ChromaDB")
-                
+            # embed_query is embed_documents([text])[0] for this model, so results are identical
+            vectors = embedding_function.embed_documents([query for query, _ in batch])
         except Exception as e:
-            print(f"    Failed to add documents: {e}")
-            import traceback
-            traceback.print_exc()
-    
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), vector in zip(batch, vectors):
+            future.set_result(vector)
+
+
+_query_batcher = _QueryEmbedBatcher()
+
+
+@functools.lru_cache(maxsize=1024)
+def embed_query(query: str) -> Tuple[float, ...]:
+    # One forward pass per distinct query, shared by the answer cache and vector search
+    return tuple(_query_batcher.submit(query).result())
 
 
 def search_vector_db(query: str, k=5, filter_type=None, section_codes=None):
@@ -230,11 +201,7 @@ def clear_database():
         vector_db.delete_collection()
         print("🗑️ [VectorDB] Collection cleared")
         
-        vector_db = Chroma(
-            persist_directory=PERSIST_DIRECTORY,
-            embedding_function=embedding_function,
-            collection_name="car_manual_rag"
-        )
+        vector_db = _open_collection(fresh=True)
         print(" [VectorDB] New empty collection created")
         
     except Exception as e:
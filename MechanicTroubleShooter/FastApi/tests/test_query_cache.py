@@ -0,0 +1,50 @@
+import unittest
+import numpy as np
+from langchain_core.documents import Document
+from services.retrieval.query_cache import SemanticQueryCache
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+class SemanticQueryCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = SemanticQueryCache(threshold=0.95)
+        # MiniLM puts queries that differ only in a code well above the threshold
+        self.p0401 = _unit([1.0, 0.0, 0.0, 0.0])
+        self.p0402 = _unit([1.0, 0.05, 0.0, 0.0])
+        self.result = {
+            "answer": "EGR flow insufficient",
+            "sources": [Document(page_content="P0401 ...", metadata={"page": 12})],
+            "formatted_sources": [{"page": 12}]
+        }
+
+    def test_other_fault_code_misses(self):
+        self.assertGreater(float(self.p0401 @ self.p0402), 0.95)
+        self.cache.put(self.p0401, self.result, query="P0401 meaning")
+        self.assertIsNone(self.cache.get(self.p0402, query="P0402 meaning"))
+
+    def test_same_code_paraphrase_hits(self):
+        self.cache.put(self.p0401, self.result, query="P0401 meaning")
+        cached = self.cache.get(self.p0402, query="What does p0401 mean?")
+        self.assertEqual(cached["answer"], self.result["answer"])
+
+    def test_code_added_or_dropped_misses(self):
+        self.cache.put(self.p0401, self.result, query="EGR valve fault")
+        self.assertIsNone(self.cache.get(self.p0401, query="EGR valve fault P0401"))
+
+    def test_hits_are_copies(self):
+        self.cache.put(self.p0401, self.result, query="P0401 meaning")
+        first = self.cache.get(self.p0401, query="P0401 meaning")
+        first["sources"][0].metadata["page"] = 99
+        first["formatted_sources"].clear()
+        second = self.cache.get(self.p0401, query="P0401 meaning")
+        self.assertEqual(second["sources"][0].metadata["page"], 12)
+        self.assertEqual(second["formatted_sources"], [{"page": 12}])
+
+
+if __name__ == "__main__":
+    unittest.main()